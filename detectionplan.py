@@ -0,0 +1,66 @@
+class DetectionPlan:
+    # The detections whose results can change OverStim's output, compiled from config.ini once at startup.
+    # OverwatchStateTracker.refresh and Hero.detect_all skip every template that isn't in the plan.
+    # A plan with enabled_templates=None runs everything.
+    def __init__(self, enabled_templates=None):
+        self.enabled_templates = None if enabled_templates is None else set(enabled_templates)
+
+    @classmethod
+    def from_config(cls, section):
+        # Killcam and death spectating decide whether the player is alive, and weapons are used for hero detection, so they always run
+        enabled_templates = {
+            "killcam",
+            "death_spec",
+            "baptiste_weapon",
+            "brigitte_weapon",
+            "kiriko_weapon",
+            "lucio_weapon",
+            "mercy_staff",
+            "mercy_pistol",
+            "mercy_pistol_ult",
+            "zenyatta_weapon",
+            "juno_weapon",
+        }
+
+        # Each kill feed row only counts its first matching notif type and stops at the first empty row,
+        # so leaving one type out would make its rows hide the ones below. The notifs are all checked or none are.
+        # Mercy's resurrect detection is only attempted while a save notif is on screen.
+        if section.getboolean("VIBE_FOR_ELIM") or section.getboolean("VIBE_FOR_ASSIST") or section.getboolean("VIBE_FOR_SAVE") or section.getboolean("MERCY_VIBE_FOR_RESURRECT"):
+            enabled_templates.update(["elimination", "assist", "save"])
+
+        if section.getboolean("VIBE_FOR_BEING_BEAMED"):
+            enabled_templates.add("being_beamed")
+        if section.getboolean("VIBE_FOR_BEING_ORBED"):
+            enabled_templates.add("being_orbed")
+        if section.getint("HACKED_EVENT") != 0:
+            enabled_templates.add("hacked")
+
+        if section.getboolean("JUNO_VIBE_FOR_GLIDE_BOOST"):
+            enabled_templates.add("juno_glide_boost")
+        if section.getboolean("JUNO_VIBE_FOR_PULSAR_TORPEDOES"):
+            enabled_templates.update(["juno_pulsar_torpedoes", "juno_pulsar_torpedoes_timer"])
+
+        # Detecting one song or beam switches the other off, so they're checked in pairs
+        if section.getboolean("LUCIO_VIBE_FOR_HEALING_SONG") or section.getboolean("LUCIO_VIBE_FOR_SPEED_SONG"):
+            enabled_templates.update(["lucio_heal", "lucio_speed"])
+        if section.getboolean("MERCY_VIBE_FOR_HEAL_BEAM") or section.getboolean("MERCY_VIBE_FOR_DAMAGE_BEAM"):
+            enabled_templates.update(["mercy_heal_beam", "mercy_damage_beam"])
+        # Save vibes are suppressed while Mercy is resurrecting
+        if section.getboolean("MERCY_VIBE_FOR_RESURRECT") or section.getboolean("VIBE_FOR_SAVE"):
+            enabled_templates.add("mercy_resurrect_cd")
+
+        if section.getboolean("ZEN_VIBE_FOR_HARMONY_ORB"):
+            enabled_templates.add("zenyatta_harmony")
+        if section.getboolean("ZEN_VIBE_FOR_DISCORD_ORB"):
+            enabled_templates.add("zenyatta_discord")
+
+        return cls(enabled_templates)
+
+    def is_enabled(self, template_name):
+        return self.enabled_templates is None or template_name in self.enabled_templates
+
+    def filter(self, template_names):
+        return [template_name for template_name in template_names if self.is_enabled(template_name)]
+
+    def get_skipped(self, template_names):
+        return [template_name for template_name in template_names if not self.is_enabled(template_name)]
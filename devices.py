@@ -0,0 +1,220 @@
+import asyncio
+import time
+
+from timing import timings
+from eventlog import event_log
+
+
+def round_value_to_nearest_step(value, step):
+    digits_to_round_to = len(str(float(step)).split(".")[1])
+    return round(step * round(value / step, 0), digits_to_round_to)
+
+
+class ActuatorOutput:
+    # Every intensity an actuator can be set to, worked out once when its device connects.
+    # Intensities are rounded to the closest step the actuator supports, and limited to the user-defined max intensity.
+    def __init__(self, actuator, max_intensity):
+        self.actuator = actuator
+        self.step = 1 / actuator.step_count
+        self.levels = [round_value_to_nearest_step(step_index * self.step, self.step) for step_index in range(actuator.step_count + 1)]
+        self.max_step_index = min(round(max_intensity / self.step), actuator.step_count)
+        while self.max_step_index > 0 and self.levels[self.max_step_index] > max_intensity:
+            self.max_step_index -= 1
+        # The last intensity sent, None if it isn't known
+        self.intensity = None
+
+    def quantise(self, intensity):
+        return self.levels[max(0, min(round(intensity / self.step), self.max_step_index))]
+
+
+class DeviceOutput:
+    # Sends intensities to one device on a fixed-rate clock. Changes between ticks are coalesced into the newest one,
+    # and with a ramp duration each tick sends a step along a line from the previous level to the new one.
+    def __init__(self, device, max_intensity, rate=0, ramp_duration=0):
+        self.device = device
+        self.actuators = [ActuatorOutput(actuator, max_intensity) for actuator in device.actuators]
+        self.period = 1 / rate if rate > 0 else 0
+        self.ramp_duration = ramp_duration
+        self.next_tick_time = 0
+        self.target_intensity = 0
+        self.target_changed = False
+        self.ramp_start_intensity = 0
+        self.ramp_start_time = 0
+        self.level = 0 # The last intensity sent, before being rounded to each actuator's steps
+        self.pending = False
+        self.commands_sent = 0
+        self.commands_suppressed = 0
+        self.first_command_time = None
+        self.last_command_time = None
+        # (trigger, capture time, vibe creation time) of the vibes waiting for this device to react to them
+        self.traces = []
+
+    def set_target(self, intensity, current_time, traces=()):
+        # A change that's replaced before the next tick never gets sent
+        if self.target_changed:
+            self.commands_suppressed += 1
+        self.ramp_start_intensity = self.get_level(current_time)
+        self.ramp_start_time = current_time
+        self.target_intensity = intensity
+        self.target_changed = True
+        self.pending = True
+        self.traces.extend(traces)
+
+    def get_level(self, current_time):
+        if not self.pending:
+            return self.level
+        if self.ramp_duration <= 0:
+            return self.target_intensity
+        progress = min((current_time - self.ramp_start_time) / self.ramp_duration, 1)
+        return self.ramp_start_intensity + (self.target_intensity - self.ramp_start_intensity) * progress
+
+    def is_due(self, current_time):
+        return self.pending and current_time >= self.next_tick_time
+
+    def get_next_tick_time(self):
+        # None when there's nothing to send, or when ramp steps are sent on every update because there's no rate
+        if not self.pending or self.period <= 0:
+            return None
+        return self.next_tick_time
+
+    async def tick(self, current_time):
+        # Returns every actuator's intensity, or None if no actuator's step changed
+        level = self.get_level(current_time)
+        self.target_changed = False
+        # Ticks stay on the rate's schedule, unless the device has been idle for longer than a tick,
+        # in which case the change is sent straight away and the schedule starts again from now
+        self.next_tick_time += self.period
+        if self.next_tick_time <= current_time:
+            self.next_tick_time = current_time + self.period
+        actuator_intensities = await self.set_intensity(level)
+        self.level = level
+        self.pending = level != self.target_intensity
+        if actuator_intensities is None:
+            self.commands_suppressed += 1
+        else:
+            self.commands_sent += 1
+            if self.first_command_time is None:
+                self.first_command_time = current_time
+            self.last_command_time = current_time
+            self.record_latency()
+        if not self.pending:
+            # Vibes that didn't move any actuator a step never reached the device
+            self.traces = []
+        return actuator_intensities
+
+    def record_latency(self):
+        # The device has reacted to every vibe waiting on it, so their latency from capture to command is known
+        command_time = time.time()
+        for trigger, source_time, vibe_time in self.traces:
+            timings.add(f"trigger latency {trigger}", command_time - source_time)
+            timings.add("latency capture to vibe", vibe_time - source_time)
+            timings.add("latency vibe to command", command_time - vibe_time)
+        self.traces = []
+
+    async def set_intensity(self, intensity):
+        # Only actuators whose quantised intensity changed are sent a command. Returns every actuator's intensity, or None if none changed.
+        actuator_intensities = [actuator.quantise(intensity) for actuator in self.actuators]
+        changed_actuators = [(actuator, actuator_intensity) for actuator, actuator_intensity in zip(self.actuators, actuator_intensities) if actuator.intensity != actuator_intensity]
+        if not changed_actuators:
+            return None
+        await asyncio.gather(*(actuator.actuator.command(actuator_intensity) for actuator, actuator_intensity in changed_actuators))
+        for actuator, actuator_intensity in changed_actuators:
+            actuator.intensity = actuator_intensity
+        return actuator_intensities
+
+    def forget_intensities(self, intensity=None):
+        # After a stop the actuators are known to be at 0, after an error they could be at anything
+        for actuator in self.actuators:
+            actuator.intensity = intensity
+        # Either way, nothing more is sent until the intensity changes again
+        if intensity is not None:
+            self.level = self.target_intensity = intensity
+        self.target_changed = False
+        self.traces = []
+        self.pending = False
+
+    def get_command_rate(self):
+        if self.first_command_time is None or self.last_command_time <= self.first_command_time:
+            return 0
+        return (self.commands_sent - 1) / (self.last_command_time - self.first_command_time)
+
+    def __str__(self):
+        return f"{self.device.name}: {self.commands_sent} commands sent ({round(self.get_command_rate(), 2)}/s), {self.commands_suppressed} suppressed"
+
+
+class DeviceOutputs:
+    # Sends intensities to every device at once, so one slow device doesn't delay the others,
+    # and an error on one device only stops that device.
+    # rate is how many times per second a device can be sent a new intensity (0 for every change), and device_rates overrides it by device name.
+    def __init__(self, max_intensity=1, rate=0, device_rates=None, ramp_duration=0):
+        self.max_intensity = max_intensity
+        self.rate = rate
+        self.device_rates = device_rates or {}
+        self.ramp_duration = ramp_duration
+        self.target_intensity = 0
+        self.target_traces = []
+        self.outputs = {}
+
+    def get_output(self, device):
+        output = self.outputs.get(device.index)
+        # A device that reconnects gets a new index or object, and could have different actuators
+        if output is None or output.device is not device:
+            output = self.outputs[device.index] = DeviceOutput(device, self.max_intensity, self.device_rates.get(device.name, self.rate), self.ramp_duration)
+        return output
+
+    def update_devices(self, devices):
+        # Builds the tables for newly connected devices and drops the ones for devices that have gone
+        outputs = {device.index: self.get_output(device) for device in devices}
+        self.outputs = outputs
+
+    def set_intensity(self, intensity, traces=()):
+        # Sent to each device on its next tick. traces are the vibes that caused the change, see VibeManager.new_traces.
+        self.target_intensity = intensity
+        self.target_traces = list(traces)
+
+    async def update(self, devices, current_time):
+        with timings.time("device output"):
+            await asyncio.gather(*(self._update_device(device, current_time) for device in devices))
+        # Every device has picked up the traces of the latest change, so devices that connect later don't count them
+        self.target_traces = []
+
+    async def stop(self, devices):
+        self.target_intensity = 0
+        self.target_traces = []
+        await asyncio.gather(*(self._stop_device(device) for device in devices))
+
+    def get_next_tick_time(self):
+        # The soonest a device is due a command it's waiting on, or None if none are
+        tick_times = [output.get_next_tick_time() for output in self.outputs.values()]
+        return min((tick_time for tick_time in tick_times if tick_time is not None), default=None)
+
+    def get_stats(self):
+        return list(self.outputs.values())
+
+    async def _update_device(self, device, current_time):
+        output = self.get_output(device)
+        if output.target_intensity != self.target_intensity:
+            output.set_target(self.target_intensity, current_time, self.target_traces)
+        if not output.is_due(current_time):
+            return
+        try:
+            with timings.time(f"device {device.name}"):
+                actuator_intensities = await output.tick(current_time)
+        except Exception as device_intensity_update_error:
+            event_log.log(f"Stopping {device.name} due to an error while altering its vibration.\n{device_intensity_update_error}")
+            output.forget_intensities()
+            await self._stop_device(device)
+            return
+
+        if actuator_intensities is not None:
+            # Print new intensities of device actuators
+            event_log.log(f"[{device.name}] " + ", ".join(f"Vibe {index + 1}: {actuator_intensity}" for index, actuator_intensity in enumerate(actuator_intensities)), kind="device", source=device.index)
+
+    async def _stop_device(self, device):
+        try:
+            await device.stop()
+        except Exception as device_stop_error:
+            event_log.log(f"Could not stop {device.name}: {device_stop_error}")
+            self.get_output(device).forget_intensities()
+            return
+        self.get_output(device).forget_intensities(0.0)
@@ -0,0 +1,108 @@
+from collections import deque
+import threading
+import queue
+import time
+import sys
+
+
+class EventLog:
+    # Messages are queued and written by a background thread, so logging from the update path never waits on the console or the output window.
+    # Each kind of message can be rate limited, and only the newest history_size lines are kept for the output window.
+    # It's also a file-like object, so sys.stdout can be pointed at it to send print() through the same queue.
+    def __init__(self, stream=None, history_size=500, queue_size=10000):
+        self.stream = stream
+        self.history = deque(maxlen=history_size)
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.min_intervals = {}
+        self.last_log_times = {}
+        self.suppressed = {}
+        self.dropped = 0
+        self.changed = False
+        self.partial_line = ""
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def set_history_size(self, history_size):
+        with self.lock:
+            self.history = deque(self.history, maxlen=history_size)
+
+    def set_rate_limits(self, rate_limits):
+        # {kind: messages per second}, e.g. {"intensity": 10}. Kinds without a limit are never suppressed.
+        self.min_intervals = {kind: 1 / rate for kind, rate in rate_limits.items() if rate > 0}
+
+    def log(self, message, kind=None, source=None):
+        # source separates messages of the same kind that are limited separately, e.g. one device's commands from another's
+        if kind in self.min_intervals:
+            key = (kind, source)
+            current_time = time.monotonic()
+            last_log_time = self.last_log_times.get(key)
+            if last_log_time is not None and current_time - last_log_time < self.min_intervals[kind]:
+                self.suppressed[key] = self.suppressed.get(key, 0) + 1
+                return
+            self.last_log_times[key] = current_time
+            suppressed = self.suppressed.pop(key, 0)
+            if suppressed:
+                message += f" ({suppressed} similar suppressed)"
+        self._put(message)
+
+    def write(self, text):
+        # print() writes the message and the line ending separately, so lines are only queued once they're complete
+        with self.lock:
+            lines = (self.partial_line + text).split("\n")
+            self.partial_line = lines.pop()
+        for line in lines:
+            self._put(line)
+        return len(text)
+
+    def flush(self):
+        # Called by print() and logging after every message, so it mustn't wait for the queue to be written
+        pass
+
+    def wait_until_written(self):
+        if self.thread is not None:
+            self.queue.join()
+
+    def get_text(self):
+        with self.lock:
+            self.changed = False
+            return "\n".join(self.history)
+
+    def _put(self, message):
+        if self.thread is None:
+            self._start()
+        try:
+            self.queue.put_nowait(message)
+        except queue.Full:
+            # Only happens if the console or window stops accepting output, in which case the update path carries on without it
+            self.dropped += 1
+
+    def _start(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._write_messages, name="EventLog", daemon=True)
+                self.thread.start()
+
+    def _write_messages(self):
+        while True:
+            messages = [self.queue.get()]
+            # Everything queued while the last batch was being written is written at once
+            while True:
+                try:
+                    messages.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            with self.lock:
+                self.history.extend(messages)
+                self.changed = True
+            if self.stream is not None:
+                try:
+                    self.stream.write("\n".join(messages) + "\n")
+                    self.stream.flush()
+                except Exception:
+                    pass
+            for _ in messages:
+                self.queue.task_done()
+
+
+# Shared by every module, like timings. Writes to the console until OverStim points it at the output window.
+event_log = EventLog(sys.stdout)
@@ -0,0 +1,204 @@
+import argparse
+import asyncio
+import json
+import random
+import time
+
+import websockets
+
+from devices import DeviceOutputs
+from timing import timings
+
+
+# Buttplug error codes
+error_device = 4
+error_message = 3
+
+
+class VirtualDevice:
+    # A device that accepts ScalarCmd and StopDeviceCmd. Every command waits for latency seconds,
+    # and fails with probability failure_rate, like a device that drops out of Bluetooth range.
+    def __init__(self, index, name, actuator_count=1, step_count=20, latency=0, failure_rate=0):
+        self.index = index
+        self.name = name
+        self.actuator_count = actuator_count
+        self.step_count = step_count
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.scalars = [0.0] * actuator_count
+        self.commands = 0
+        self.stops = 0
+        self.failures = 0
+
+    def get_info(self):
+        return {
+            "DeviceName": self.name,
+            "DeviceIndex": self.index,
+            "DeviceMessages": {
+                "ScalarCmd": [{"FeatureDescriptor": f"Vibrator {actuator_index + 1}", "StepCount": self.step_count, "ActuatorType": "Vibrate"} for actuator_index in range(self.actuator_count)],
+                "StopDeviceCmd": {},
+            },
+        }
+
+    async def command(self, scalars):
+        await asyncio.sleep(self.latency)
+        if random.random() < self.failure_rate:
+            self.failures += 1
+            raise ValueError(f"{self.name} didn't respond")
+        for scalar in scalars:
+            self.scalars[scalar["Index"]] = scalar["Scalar"]
+        self.commands += 1
+
+    async def stop(self):
+        await asyncio.sleep(self.latency)
+        if random.random() < self.failure_rate:
+            self.failures += 1
+            raise ValueError(f"{self.name} didn't respond")
+        self.scalars = [0.0] * self.actuator_count
+        self.stops += 1
+
+    def __str__(self):
+        return f"{self.name}: {self.commands} commands, {self.stops} stops, {self.failures} failures"
+
+
+class FakeIntifaceServer:
+    # Implements the parts of the Buttplug v3 protocol that OverStim's client uses, for testing without Intiface Central or hardware
+    def __init__(self, devices, host="127.0.0.1", port=12345, max_ping_time=0):
+        self.devices = {device.index: device for device in devices}
+        self.host = host
+        self.port = port
+        self.max_ping_time = max_ping_time
+        self.server = None
+
+    async def start(self):
+        self.server = await websockets.serve(self._handle_connection, self.host, self.port)
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def _handle_connection(self, websocket):
+        tasks = set()
+        async for raw_messages in websocket:
+            for message in json.loads(raw_messages):
+                # Device commands are answered when the device responds, without holding up the rest of the connection
+                task = asyncio.create_task(self._handle_message(websocket, message))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+
+    async def _handle_message(self, websocket, message):
+        message_type, fields = next(iter(message.items()))
+        message_id = fields.get("Id", 0)
+        responses = []
+        try:
+            if message_type == "RequestServerInfo":
+                responses.append({"ServerInfo": {"Id": message_id, "ServerName": "OverStim Fake Intiface", "MessageVersion": 3, "MaxPingTime": self.max_ping_time}})
+            elif message_type == "RequestDeviceList":
+                responses.append({"DeviceList": {"Id": message_id, "Devices": [device.get_info() for device in self.devices.values()]}})
+            elif message_type in ("Ping", "StartScanning"):
+                responses.append({"Ok": {"Id": message_id}})
+            elif message_type == "StopScanning":
+                responses.append({"Ok": {"Id": message_id}})
+                responses.append({"ScanningFinished": {"Id": 0}})
+            elif message_type == "ScalarCmd":
+                await self._get_device(fields["DeviceIndex"]).command(fields["Scalars"])
+                responses.append({"Ok": {"Id": message_id}})
+            elif message_type == "StopDeviceCmd":
+                await self._get_device(fields["DeviceIndex"]).stop()
+                responses.append({"Ok": {"Id": message_id}})
+            elif message_type == "StopAllDevices":
+                await asyncio.gather(*(device.stop() for device in self.devices.values()), return_exceptions=True)
+                responses.append({"Ok": {"Id": message_id}})
+            else:
+                responses.append({"Error": {"Id": message_id, "ErrorMessage": f"Unsupported message {message_type}", "ErrorCode": error_message}})
+        except (KeyError, ValueError) as device_error:
+            responses.append({"Error": {"Id": message_id, "ErrorMessage": str(device_error), "ErrorCode": error_device}})
+        try:
+            await websocket.send(json.dumps(responses))
+        except websockets.ConnectionClosed:
+            pass
+
+    def _get_device(self, device_index):
+        if device_index not in self.devices:
+            raise KeyError(f"No device with index {device_index}")
+        return self.devices[device_index]
+
+
+def create_devices(device_count, actuator_count=1, step_count=20, latency=0, failure_rate=0):
+    return [VirtualDevice(index, f"Virtual Device {index + 1}", actuator_count, step_count, latency, failure_rate) for index in range(device_count)]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Run a stand-in for Intiface Central with virtual devices, or benchmark OverStim's device output against it.")
+    parser.add_argument("mode", choices=["serve", "benchmark"], help="serve: run until stopped, for OverStim to connect to. benchmark: measure command throughput for each device count")
+    parser.add_argument("--devices", default="2", help="Number of virtual devices, or a comma separated list of device counts to benchmark, e.g. 1,2,4,8")
+    parser.add_argument("--actuators", type=int, default=1, help="Actuators per device")
+    parser.add_argument("--steps", type=int, default=20, help="Intensity steps each actuator supports")
+    parser.add_argument("--latency-ms", type=float, default=0, help="Milliseconds each device takes to respond to a command")
+    parser.add_argument("--failure-rate", type=float, default=0, help="Chance of each command failing, from 0 to 1")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=12345)
+    parser.add_argument("--duration", type=float, default=5, help="Seconds to benchmark each device count for")
+    parser.add_argument("--output-rate", type=float, default=0, help="DEVICE_OUTPUT_RATE to benchmark with (0 sends every change)")
+    return parser.parse_args()
+
+
+async def serve(args):
+    devices = create_devices(int(args.devices), args.actuators, args.steps, args.latency_ms / 1000, args.failure_rate)
+    server = FakeIntifaceServer(devices, args.host, args.port)
+    await server.start()
+    print(f"Serving {len(devices)} virtual devices on ws://{args.host}:{args.port}. Press Ctrl+C to stop.")
+    try:
+        await asyncio.Future()
+    finally:
+        await server.stop()
+        for device in devices:
+            print(device)
+
+
+async def benchmark(args, device_count):
+    # Imported here so serve mode only needs websockets
+    from buttplug import Client, WebsocketConnector, ProtocolSpec
+
+    virtual_devices = create_devices(device_count, args.actuators, args.steps, args.latency_ms / 1000, args.failure_rate)
+    server = FakeIntifaceServer(virtual_devices, args.host, args.port)
+    await server.start()
+    client = Client("OverStim Benchmark", ProtocolSpec.v3)
+    await client.connect(WebsocketConnector(f"ws://{args.host}:{args.port}", logger=client.logger))
+    devices = list(client.devices.values())
+    device_outputs = DeviceOutputs(rate=args.output_rate)
+    device_outputs.update_devices(devices)
+
+    timings.reset()
+    updates = 0
+    start_time = time.perf_counter()
+    while time.perf_counter() - start_time < args.duration:
+        # A new intensity every update, so every actuator has a command to send whenever it's due
+        device_outputs.set_intensity(random.random())
+        await device_outputs.update(devices, time.perf_counter())
+        updates += 1
+    duration = time.perf_counter() - start_time
+    await device_outputs.stop(devices)
+    await client.disconnect()
+    await server.stop()
+
+    commands = sum(device.commands for device in virtual_devices)
+    failures = sum(device.failures for device in virtual_devices)
+    fan_out = timings.get_histogram("device output").get_summary()
+    print(f"{device_count} devices: {updates} updates ({round(updates / duration, 1)}/s) | {commands} commands ({round(commands / duration, 1)}/s) | {failures} failures"
+          f" | fan-out p50 {fan_out['p50_ms']}ms, p95 {fan_out['p95_ms']}ms, p99 {fan_out['p99_ms']}ms")
+    for output in device_outputs.get_stats():
+        print(f"  {output}")
+
+
+async def run_benchmarks(args):
+    for device_count in [int(device_count) for device_count in args.devices.split(",")]:
+        await benchmark(args, device_count)
+
+
+if __name__ == "__main__":
+    arguments = parse_args()
+    try:
+        asyncio.run(serve(arguments) if arguments.mode == "serve" else run_benchmarks(arguments))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,192 @@
+from abc import ABC, abstractmethod
+import os
+import time
+
+import numpy as np
+import cv2 as cv
+
+
+video_extensions = (".mp4", ".mkv", ".avi", ".mov", ".webm")
+image_extensions = (".png", ".jpg", ".jpeg", ".bmp")
+
+
+class ReplayFinished(Exception):
+    pass
+
+
+class FrameSource(ABC):
+    # Frames are handed to ComputerVision in the same channel order dxcam uses (RGB)
+    def __init__(self):
+        # The time the state's timers follow for the latest frame
+        self.latest_frame_time = 0
+        # Wall clock time the latest frame was captured, or as close to it as the source can tell, which latency traces start from
+        self.latest_capture_time = 0
+
+    @abstractmethod
+    def grab(self):
+        pass
+
+    def start(self, target_fps=60):
+        return
+
+    def stop(self):
+        return
+
+    @abstractmethod
+    def get_latest_frame(self):
+        pass
+
+
+class DXCamFrameSource(FrameSource):
+    def __init__(self):
+        super().__init__()
+        # Only available on Windows, so it is imported here rather than at module level
+        import dxcam_cpp
+        self.screen = dxcam_cpp.create(max_buffer_len=1)
+
+    def grab(self):
+        return self.screen.grab()
+
+    def start(self, target_fps=60):
+        self.screen.start(target_fps=target_fps, video_mode=True)
+
+    def stop(self):
+        self.screen.stop()
+
+    def get_latest_frame(self):
+        frame = self.screen.get_latest_frame()
+        # dxcam_cpp doesn't give the time a frame was captured, so this is the time it was handed over. A frame can wait in dxcam's
+        # buffer for up to one capture period before that, which the traced "capture to ..." latencies don't include.
+        self.latest_capture_time = time.time()
+        self.latest_frame_time = self.latest_capture_time
+        return frame
+
+
+class ReplayFrameSource(FrameSource):
+    # Plays back a recorded match from a directory of images, a video file or a .npy stack of frames.
+    # rate: frames per second to deliver frames at, or None to deliver them as fast as they are requested.
+    # When a rate is set, frames the consumer is too slow to pick up are skipped, like a live capture would.
+    # Frame times follow the recording (source_fps) rather than the wall clock, so timers behave the same at any rate.
+    def __init__(self, path, rate=None, loop=False, source_fps=None, preload=False):
+        super().__init__()
+        self.path = path
+        self.rate = rate
+        self.loop = loop
+        self.video = None
+        self.frames = None
+        self.image_paths = None
+
+        if os.path.isdir(path):
+            self.image_paths = sorted(
+                os.path.join(path, file_name) for file_name in os.listdir(path) if file_name.lower().endswith(image_extensions)
+            )
+            self.frame_count = len(self.image_paths)
+            if preload:
+                self.frames = [self._read_image(image_path) for image_path in self.image_paths]
+        elif path.lower().endswith(".npy"):
+            self.frames = np.load(path, mmap_mode=None if preload else "r")
+            self.frame_count = len(self.frames)
+        elif path.lower().endswith(video_extensions):
+            self.video = cv.VideoCapture(path)
+            if not self.video.isOpened():
+                raise ValueError(f"Could not open replay video {path}")
+            self.frame_count = int(self.video.get(cv.CAP_PROP_FRAME_COUNT))
+            if source_fps is None:
+                source_fps = self.video.get(cv.CAP_PROP_FPS) or None
+            if preload:
+                self.frames = [frame for frame in iter(self._read_video_frame, None)]
+                self.frame_count = len(self.frames)
+                self.video.release()
+                self.video = None
+        else:
+            raise ValueError(f"Unsupported replay source {path}")
+
+        if self.frame_count == 0:
+            raise ValueError(f"Replay source {path} contains no frames")
+
+        self.source_fps = source_fps or rate or 60
+        self.frames_delivered = 0
+        self.frames_skipped = 0
+        self.last_wait_time = 0
+        self.next_index = 0
+        self.video_index = 0
+        self.start_time = 0
+        self.frame_time_origin = 0
+
+    @staticmethod
+    def _read_image(image_path):
+        return cv.cvtColor(cv.imread(image_path), cv.COLOR_BGR2RGB)
+
+    def _read_video_frame(self):
+        success, frame = self.video.read()
+        if not success:
+            return None
+        self.video_index += 1
+        return cv.cvtColor(frame, cv.COLOR_BGR2RGB)
+
+    def _load_frame(self, index):
+        if self.frames is not None:
+            return self.frames[index]
+        if self.image_paths is not None:
+            return self._read_image(self.image_paths[index])
+        if index < self.video_index:
+            self.video.set(cv.CAP_PROP_POS_FRAMES, index)
+            self.video_index = index
+        while self.video_index < index:
+            self.video.grab()
+            self.video_index += 1
+        frame = self._read_video_frame()
+        if frame is None:
+            raise ReplayFinished
+        return frame
+
+    def grab(self):
+        return self._load_frame(0)
+
+    def start(self, target_fps=60):
+        if self.video is None and self.frames is None and self.image_paths is None:
+            self.video = cv.VideoCapture(self.path)
+            self.video_index = 0
+        self.start_time = time.time()
+        self.frame_time_origin = self.start_time
+        self.next_index = 0
+
+    def stop(self):
+        if self.video is not None:
+            self.video.release()
+            self.video = None
+
+    def get_latest_frame(self):
+        index = self.next_index
+        self.last_wait_time = 0
+        if self.rate:
+            due_time = self.start_time + index / self.rate
+            current_time = time.time()
+            if current_time < due_time:
+                self.last_wait_time = due_time - current_time
+                time.sleep(self.last_wait_time)
+            else:
+                index = max(index, int((current_time - self.start_time) * self.rate))
+        if index >= self.frame_count and not self.loop:
+            self.frames_skipped += max(0, self.frame_count - self.next_index)
+            self.next_index = self.frame_count
+            raise ReplayFinished
+        self.frames_skipped += index - self.next_index
+
+        if index >= self.frame_count:
+            # Restart the recording, keeping frame times increasing
+            loops = index // self.frame_count
+            index %= self.frame_count
+            if self.rate:
+                self.start_time += loops * self.frame_count / self.rate
+            self.frame_time_origin += loops * self.frame_count / self.source_fps
+            if self.video is not None:
+                self.video.set(cv.CAP_PROP_POS_FRAMES, 0)
+                self.video_index = 0
+
+        frame = self._load_frame(index)
+        self.frames_delivered += 1
+        self.next_index = index + 1
+        self.latest_capture_time = time.time()
+        self.latest_frame_time = self.frame_time_origin + index / self.source_fps
+        return frame
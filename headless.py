@@ -0,0 +1,162 @@
+import argparse
+import configparser
+import asyncio
+import logging
+import signal
+import json
+import time
+import sys
+
+from buttplug import Client, WebsocketConnector, ProtocolSpec
+
+from framesources import ReplayFrameSource
+from session import OverStimSession
+from vibes import VibeManager
+from eventlog import event_log
+
+
+# Runs OverStim without the window, for machines where the GUI costs too much per frame (e.g. streaming or capture PCs).
+# Started and stopped from the command line: Ctrl+C (or SIGTERM) stops every device and quits, as does the emergency stop key combo.
+
+
+def make_parser():
+    parser = argparse.ArgumentParser(description="Run OverStim without its window.")
+    parser.add_argument("--config", default="config.ini", help="Config file to read (default: config.ini)")
+    parser.add_argument("--hero", default=None, help="Play as this hero instead of auto-detecting")
+    parser.add_argument("--no-intiface", action="store_true", help="Run detection and vibes without connecting to Intiface, like USING_INTIFACE = False")
+    parser.add_argument("--no-emergency-stop-key", action="store_true", help="Don't listen for EMERGENCY_STOP_KEY_COMBO (e.g. when running as a service); Ctrl+C still stops")
+    parser.add_argument("--duration", type=float, default=None, help="Stop after this many seconds")
+    parser.add_argument("--replay", default=None, help="Loop a recording (see replay.py) instead of capturing the screen")
+    return parser
+
+
+class HeadlessOverStim:
+    def __init__(self, args, section):
+        self.args = args
+        self.section = section
+        self.using_intiface = section.getboolean("USING_INTIFACE") and not args.no_intiface
+        self.excluded_device_names = json.loads(section.get("EXCLUDED_DEVICE_NAMES"))
+        self.client = Client("OverStim", ProtocolSpec.v3)
+        self.scanning = False
+        self.stop_reason = None
+        self.start_time = 0
+        self.device_count = 0
+
+        self.vibe_manager = VibeManager(get_devices=self.get_devices)
+        self.session = OverStimSession(section, self.vibe_manager)
+        self.session.load_player(ReplayFrameSource(args.replay, loop=True, preload=True) if args.replay else None)
+
+    def get_hero_names(self):
+        return ["Other"] + list(self.session.player.supported_heroes)
+
+    def play_as(self, hero_name):
+        player = self.session.player
+        player.hero_auto_detect = False
+        player.switch_hero(hero_name)
+
+    def get_devices(self):
+        if not self.using_intiface:
+            return []
+        return [device for device in self.client.devices.values() if device.name not in self.excluded_device_names]
+
+    def request_stop(self, reason):
+        # Called from signal handlers and the emergency stop listener's thread, so it only sets a flag for the running loop
+        if self.stop_reason is None:
+            self.stop_reason = reason
+        self.vibe_manager.stopped = True
+
+    async def connect(self):
+        address = f"{self.section['WEBSOCKET_ADDRESS']}:{self.section['WEBSOCKET_PORT']}"
+        await self.client.connect(WebsocketConnector(address, logger=self.client.logger))
+        print("Connected to Intiface")
+        await self.client.start_scanning()
+        self.scanning = True
+        if not self.section.getboolean("CONTINUOUS_SCANNING"):
+            await asyncio.sleep(0.2)
+            await self.client.stop_scanning()
+            self.scanning = False
+        print("Started scanning")
+
+    async def disconnect(self):
+        if self.using_intiface and self.client.connected:
+            if self.scanning:
+                await self.client.stop_scanning()
+            await self.client.disconnect()
+            print("Disconnected.")
+
+    def poll(self):
+        # Called by the running loop between frames. Returns why it should stop, or None to keep going.
+        if self.using_intiface and not self.client.connected:
+            self.request_stop("Lost connection to Intiface.")
+        elif self.args.duration is not None and time.time() - self.start_time >= self.args.duration:
+            self.request_stop("Finished.")
+        current_device_count = len(self.get_devices())
+        if current_device_count != self.device_count:
+            self.device_count = current_device_count
+            self.vibe_manager.device_outputs.update_devices(self.get_devices())
+        return self.stop_reason
+
+    async def run(self):
+        # The same loop as OverStim's Start button, without the window
+        self.start_time = time.time()
+        try:
+            # Nothing needs to stay responsive between frames except the stop flag
+            await self.session.run(self.poll, max_idle_time=0.1)
+        finally:
+            # The update path's queued messages come before the stats
+            event_log.wait_until_written()
+            print(self.stop_reason or "Stopped.")
+            self.session.print_stats()
+
+
+def start_emergency_stop_listener(overstim, key_combo):
+    # pynput is only needed for the key combo, so services that don't want a keyboard hook don't import it
+    from pynput import keyboard
+    hotkey = keyboard.HotKey(keyboard.HotKey.parse(key_combo), lambda: overstim.request_stop("Emergency stop detected."))
+    listener = keyboard.Listener(on_press=lambda key: hotkey.press(listener.canonical(key)), on_release=lambda key: hotkey.release(listener.canonical(key)))
+    listener.start()
+    return listener
+
+
+async def main(parser, args):
+    config = configparser.ConfigParser()
+    if not config.read(args.config):
+        print(f"Could not read {args.config}")
+        return 1
+    section = config["OverStim"]
+    event_log.set_rate_limits(json.loads(section.get("LOG_RATE_LIMITS", fallback="{}")))
+    overstim = HeadlessOverStim(args, section)
+    # The supported heroes are only known once the player has loaded
+    if args.hero:
+        if args.hero not in overstim.get_hero_names():
+            parser.error(f"argument --hero: invalid choice: '{args.hero}' (choose from {', '.join(overstim.get_hero_names())})")
+        overstim.play_as(args.hero)
+
+    # Ctrl+C, SIGTERM from a service manager, and Ctrl+Break on Windows all stop the devices before quitting
+    for signal_name in ("SIGINT", "SIGTERM", "SIGBREAK"):
+        if hasattr(signal, signal_name):
+            signal.signal(getattr(signal, signal_name), lambda signal_number, frame: overstim.request_stop("Stop signal received."))
+
+    listener = None
+    if not args.no_emergency_stop_key:
+        listener = start_emergency_stop_listener(overstim, section["EMERGENCY_STOP_KEY_COMBO"])
+    try:
+        if overstim.using_intiface:
+            try:
+                await overstim.connect()
+            except Exception as ex:
+                print(ex)
+                print("Make sure you've started the Intiface server, then restart OverStim.")
+                return 1
+        await overstim.run()
+    finally:
+        if listener is not None:
+            listener.stop()
+        await overstim.disconnect()
+    return 0
+
+
+if __name__ == "__main__":
+    logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+    parser = make_parser()
+    sys.exit(asyncio.run(main(parser, parser.parse_args())))
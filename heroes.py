@@ -1,35 +1,58 @@
-import time
+class Hysteresis:
+    # Smooths a detection that flickers, e.g. a beam icon that briefly disappears while it switches targets.
+    # It turns on once the detection has been seen for on_delay seconds, and off once it hasn't been seen for off_delay seconds.
+    # Times are frame times, so the result is the same at any refresh rate and when replaying a recording.
+    # Delays within time_tolerance count as reached, so a delay of a whole number of frames (e.g. 366.67ms, 11 frames at 30 per second)
+    # ends on that frame even though it's rounded in config.ini, and frame times far from zero lose precision when subtracted.
+    time_tolerance = 0.0005
+
+    def __init__(self, off_delay=0, on_delay=0):
+        self.off_delay = off_delay
+        self.on_delay = on_delay
+        self.reset()
+
+    def reset(self):
+        self.value = False
+        self.first_seen_time = None
+        self.last_seen_time = None
+
+    def update(self, detected, current_time):
+        if detected:
+            if self.first_seen_time is None:
+                self.first_seen_time = current_time
+            self.last_seen_time = current_time
+            if current_time - self.first_seen_time >= self.on_delay - self.time_tolerance:
+                self.value = True
+        else:
+            self.first_seen_time = None
+            if self.value and current_time - self.last_seen_time >= self.off_delay - self.time_tolerance:
+                self.value = False
+        return self.value
 
 
 class Hero:
-    def __init__(self, name, role, weapons=None):
+    def __init__(self, name, role, weapons=None, ability_templates=None):
         self.name = name
         self.role = role
         if weapons is None:
             self.weapons = [self.name.lower()+"_weapon"]
         else:
             self.weapons = weapons
+        # Templates detect_all checks every frame, which can be scored ahead of time
+        self.ability_templates = [] if ability_templates is None else ability_templates
         self.reset_attributes()
-        
-    def detect_hero(self, owcv):
-        for weapon in self.weapons:
-            if owcv.detect_single(weapon, threshold=0.97):
-                return True
-        return False
     
     def reset_attributes(self):
         return
 
-    def detect_all(self, owcv):
+    def detect_all(self, owcv, plan):
+        # plan is the DetectionPlan, detections it doesn't enable are skipped
         return
 
 
 class Other(Hero):
     def __init__(self):
         super().__init__(name="Other", role="Other")
-    
-    def detect_hero(self, owcv=None):
-        return
 
 
 class Baptiste(Hero):
@@ -44,7 +67,11 @@ class Brigitte(Hero):
 
 class Juno(Hero):
     def __init__(self):
-        super().__init__(name="Juno", role="Support")
+        super().__init__(name="Juno", role="Support", ability_templates=[
+            "juno_glide_boost",
+            "juno_pulsar_torpedoes",
+            "juno_pulsar_torpedoes_timer",
+        ])
         self.pulsar_torpedoes_firing_lockout_duration = 0.5
         self.pulsar_torpedoes_last_start_time = 0
         self.pulsar_torpedoes_finish_lockout_duration = 0.3
@@ -59,7 +86,7 @@ class Juno(Hero):
         self.glide_boost = owcv.detect_single("juno_glide_boost")
 
     def detect_pulsar_torpedoes(self, owcv):
-        current_time = time.time()
+        current_time = owcv.frame_time
         time_since_pulsar_torpedoes_last_finished = current_time - self.pulsar_torpedoes_last_finish_time
         if time_since_pulsar_torpedoes_last_finished > self.pulsar_torpedoes_finish_lockout_duration:
             if owcv.detect_single("juno_pulsar_torpedoes"):
@@ -74,9 +101,11 @@ class Juno(Hero):
                 self.pulsar_torpedoes = False
                 self.pulsar_torpedoes_firing = False
     
-    def detect_all(self, owcv):
-        self.detect_glide_boost(owcv)
-        self.detect_pulsar_torpedoes(owcv)
+    def detect_all(self, owcv, plan):
+        if plan.is_enabled("juno_glide_boost"):
+            self.detect_glide_boost(owcv)
+        if plan.is_enabled("juno_pulsar_torpedoes"):
+            self.detect_pulsar_torpedoes(owcv)
 
 
 class Kiriko(Hero):
@@ -86,114 +115,119 @@ class Kiriko(Hero):
 
 class Lucio(Hero):
     def __init__(self):
-        super().__init__(name="Lucio", role="Support")
-        self.crossfade_buffer_size = 6 # Overridden by config.ini
-    
+        # Created before Hero.__init__, which resets them
+        self.healing_song_filter = Hysteresis(off_delay=0.2)
+        self.speed_song_filter = Hysteresis(off_delay=0.2)
+        super().__init__(name="Lucio", role="Support", ability_templates=["lucio_heal", "lucio_speed"])
+
+    def set_crossfade_delay(self, seconds):
+        # Overridden by config.ini
+        self.healing_song_filter.off_delay = seconds
+        self.speed_song_filter.off_delay = seconds
+
     def reset_attributes(self):
         self.healing_song = False
         self.speed_song = False
-        self.healing_song_buffer = 0
-        self.speed_song_buffer = 0
+        self.healing_song_filter.reset()
+        self.speed_song_filter.reset()
     
     def detect_song(self, owcv):
-        if owcv.detect_single("lucio_heal"):
-            self.healing_song = True
-            self.speed_song = False
-            self.healing_song_buffer = 0
-            self.speed_song_buffer = 0
-        elif self.healing_song:
-            self.healing_song_buffer += 1
-            if self.healing_song_buffer >= self.crossfade_buffer_size:
-                self.healing_song = False
+        # Only one song plays at a time, so seeing one ends the other straight away
+        healing_song_detected = owcv.detect_single("lucio_heal")
+        if healing_song_detected:
+            self.speed_song_filter.reset()
+        self.healing_song_filter.update(healing_song_detected, owcv.frame_time)
         
         # Can we skip this section if the previous section is True?
-        if owcv.detect_single("lucio_speed"):
-            self.speed_song = True
-            self.healing_song = False
-            self.speed_song_buffer = 0
-            self.healing_song_buffer = 0
-        elif self.speed_song:
-            self.speed_song_buffer += 1
-            if self.speed_song_buffer >= self.crossfade_buffer_size:
-                self.speed_song = False
+        speed_song_detected = owcv.detect_single("lucio_speed")
+        if speed_song_detected:
+            self.healing_song_filter.reset()
+        self.speed_song_filter.update(speed_song_detected, owcv.frame_time)
+
+        self.healing_song = self.healing_song_filter.value
+        self.speed_song = self.speed_song_filter.value
     
-    def detect_all(self, owcv):
-        self.detect_song(owcv)
+    def detect_all(self, owcv, plan):
+        if plan.is_enabled("lucio_heal"):
+            self.detect_song(owcv)
 
 
 class Mercy(Hero):
     def __init__(self):
+        # Created before Hero.__init__, which resets them
+        self.heal_beam_filter = Hysteresis(off_delay=11 / 30)
+        self.damage_beam_filter = Hysteresis(off_delay=11 / 30)
         super().__init__(name="Mercy", role="Support", weapons=[
             "mercy_staff",
             "mercy_pistol",
             "mercy_pistol_ult",
-        ])
-        self.beam_disconnect_buffer_size = 8 # Overridden by config.ini
+        ], ability_templates=["mercy_heal_beam", "mercy_damage_beam"])
+
+    def set_beam_disconnect_delay(self, seconds):
+        # Overridden by config.ini
+        self.heal_beam_filter.off_delay = seconds
+        self.damage_beam_filter.off_delay = seconds
 
     def reset_attributes(self):
         self.heal_beam = False
         self.damage_beam = False
         self.resurrecting = False
-        self.heal_beam_buffer = 0
-        self.damage_beam_buffer = 0
+        self.heal_beam_filter.reset()
+        self.damage_beam_filter.reset()
     
     def detect_beams(self, owcv):
-        if owcv.detect_single("mercy_heal_beam"):
-            self.heal_beam = True
-            self.damage_beam = False
-            self.heal_beam_buffer = 0
-            self.damage_beam_buffer = 0
-        elif self.heal_beam:
-            self.heal_beam_buffer += 1
-            if self.heal_beam_buffer >= self.beam_disconnect_buffer_size:
-                self.heal_beam = False
+        # Mercy can only use one beam at a time, so seeing one ends the other straight away
+        heal_beam_detected = owcv.detect_single("mercy_heal_beam")
+        if heal_beam_detected:
+            self.damage_beam_filter.reset()
+        self.heal_beam_filter.update(heal_beam_detected, owcv.frame_time)
         
         # Can we skip this section if the previous section is True?
-        if owcv.detect_single("mercy_damage_beam"):
-            self.damage_beam = True
-            self.heal_beam = False
-            self.damage_beam_buffer = 0
-            self.heal_beam_buffer = 0
-        elif self.damage_beam:
-            self.damage_beam_buffer += 1
-            if self.damage_beam_buffer >= self.beam_disconnect_buffer_size:
-                self.damage_beam = False
+        damage_beam_detected = owcv.detect_single("mercy_damage_beam")
+        if damage_beam_detected:
+            self.heal_beam_filter.reset()
+        self.damage_beam_filter.update(damage_beam_detected, owcv.frame_time)
+
+        self.heal_beam = self.heal_beam_filter.value
+        self.damage_beam = self.damage_beam_filter.value
     
     def detect_resurrect(self, owcv):
         self.resurrecting = owcv.detect_single("mercy_resurrect_cd")
 
+    def detect_all(self, owcv, plan):
+        # Resurrect is detected by OverwatchStateTracker, as it depends on the kill feed
+        if plan.is_enabled("mercy_heal_beam"):
+            self.detect_beams(owcv)
+
 
 class Zenyatta(Hero):
     def __init__(self):
-        super().__init__(name="Zenyatta", role="Support")
         # Orbs take up to 0.8s to switch targets at max range (w/ ~40ms RTT)
-        self.orb_disconnect_buffer_size = 30 # Overridden by config.ini
+        # Created before Hero.__init__, which resets them
+        self.harmony_orb_filter = Hysteresis(off_delay=0.9)
+        self.discord_orb_filter = Hysteresis(off_delay=0.9)
+        super().__init__(name="Zenyatta", role="Support", ability_templates=["zenyatta_harmony", "zenyatta_discord"])
+
+    def set_orb_disconnect_delay(self, seconds):
+        # Overridden by config.ini
+        self.harmony_orb_filter.off_delay = seconds
+        self.discord_orb_filter.off_delay = seconds
     
     def reset_attributes(self):
         self.harmony_orb = False
         self.discord_orb = False
-        self.harmony_orb_buffer = 0
-        self.discord_orb_buffer = 0
+        self.harmony_orb_filter.reset()
+        self.discord_orb_filter.reset()
     
-    def detect_orbs(self, owcv):
-        if owcv.detect_single("zenyatta_harmony"):
-            self.harmony_orb = True
-            self.harmony_orb_buffer = 0
-        elif self.harmony_orb:
-            self.harmony_orb_buffer += 1
-            if self.harmony_orb_buffer >= self.orb_disconnect_buffer_size:
-                self.harmony_orb = False
-
-        if owcv.detect_single("zenyatta_discord"):
-            self.discord_orb = True
-            self.discord_orb_buffer = 0
-        elif self.discord_orb:
-            self.discord_orb_buffer += 1
-            if self.discord_orb_buffer >= self.orb_disconnect_buffer_size:
-                self.discord_orb = False
+    def detect_orbs(self, owcv, plan):
+        if plan.is_enabled("zenyatta_harmony"):
+            self.harmony_orb = self.harmony_orb_filter.update(owcv.detect_single("zenyatta_harmony"), owcv.frame_time)
+
+        if plan.is_enabled("zenyatta_discord"):
+            self.discord_orb = self.discord_orb_filter.update(owcv.detect_single("zenyatta_discord"), owcv.frame_time)
     
-    def detect_all(self, owcv):
-        self.detect_orbs(owcv)
+    def detect_all(self, owcv, plan):
+        self.detect_orbs(owcv, plan)
 
 
 # HEROES = [
@@ -1,9 +1,15 @@
+import hashlib
+import json
 import os
-from math import gcd
+import threading
+import time
+from math import ceil, floor, gcd
 
 import numpy as np
 import cv2 as cv
-import dxcam_cpp
+
+from framesources import DXCamFrameSource
+from timing import timings
 
 
 resolutions_21_by_9 = (
@@ -21,17 +27,363 @@ resolutions_21_by_9 = (
 def resource_path(relative_path):
     return os.path.join(os.path.abspath("."), relative_path)
 
+def merge_regions(regions):
+    # Merges overlapping [top, bottom, left, right] regions so shared pixels are only processed once
+    merged = []
+    for region in sorted(list(region) for region in regions):
+        for other in merged:
+            if region[0] < other[1] and other[0] < region[1] and region[2] < other[3] and other[2] < region[3]:
+                other[0] = min(other[0], region[0])
+                other[1] = max(other[1], region[1])
+                other[2] = min(other[2], region[2])
+                other[3] = max(other[3], region[3])
+                break
+        else:
+            merged.append(region)
+    if len(merged) < len(regions):
+        # Growing a region can make it overlap one that was already placed
+        return merge_regions(merged)
+    return merged
+
+def get_template_signature(file_names):
+    # Changes whenever a template file is added, removed or edited
+    signature = []
+    for file_name in sorted(file_names):
+        template_stat = os.stat(resource_path(os.path.join("data", f"{file_name}.png")))
+        signature.append(f"{file_name}:{template_stat.st_size}:{template_stat.st_mtime_ns}")
+    return ";".join(signature)
+
+def get_template_norm(template, stats=None):
+    # stats from get_template_stats, if they've already been worked out for this template
+    if stats is not None:
+        return template.astype(np.float32) - np.float32(stats[0]), float(stats[1])
+    zero_mean_template = template.astype(np.float32) - np.float32(template.mean())
+    return zero_mean_template, float(np.square(zero_mean_template, dtype=np.float64).sum())
+
+def get_template_stats(template):
+    # Mean and energy (see get_template_norm), used by match_batch
+    _, template_energy = get_template_norm(template)
+    return np.array([template.mean(), template_energy])
+
+def get_template_bundle_path():
+    return resource_path(os.path.join("data", "templates.bundle"))
+
+def get_template_file_names():
+    return sorted(os.path.splitext(file_name)[0] for file_name in os.listdir(resource_path("data")) if file_name.startswith(("t_", "m_")) and file_name.endswith(".png"))
+
+def get_template_content_signature(file_names):
+    # Unlike get_template_signature this ignores modification times, which change when the bundle is copied or
+    # unpacked from the executable. Hashing the files is still much quicker than decoding them.
+    signature = hashlib.sha1()
+    for file_name in sorted(file_names):
+        with open(resource_path(os.path.join("data", f"{file_name}.png")), "rb") as template_file:
+            signature.update(file_name.encode())
+            signature.update(template_file.read())
+    return signature.hexdigest()
+
+def read_template_file(file_name):
+    return cv.cvtColor(cv.imread(resource_path(os.path.join("data", f"{file_name}.png"))), cv.COLOR_RGB2GRAY)
+
+def build_template_bundle(path=None):
+    # Packs every grayscale template and mask in data, and each template's stats, into one file, so starting OverStim
+    # doesn't have to decode a PNG per template. Run owcv.py to rebuild it after editing a template.
+    # The file is a line of JSON describing each image, then every image's pixels end to end.
+    # It isn't an .npz because importing zipfile takes longer than decoding the PNGs.
+    path = path or get_template_bundle_path()
+    file_names = get_template_file_names()
+    images = [read_template_file(file_name) for file_name in file_names]
+    index = {"signature": get_template_content_signature(file_names), "images": []}
+    offset = 0
+    for file_name, image in zip(file_names, images):
+        # Masks aren't matched on their own, so they have no stats
+        index["images"].append({"name": file_name, "shape": image.shape, "offset": offset, "stats": get_template_stats(image).tolist() if file_name.startswith("t_") else None})
+        offset += image.size
+    with open(path, "wb") as bundle_file:
+        bundle_file.write(json.dumps(index).encode() + b"\n")
+        for image in images:
+            bundle_file.write(np.ascontiguousarray(image).tobytes())
+    return file_names
+
+def load_template_bundle(file_names, path=None):
+    # Returns ({file name: image}, {file name: stats}), or None if there's no bundle or it's older than the PNGs in data
+    path = path or get_template_bundle_path()
+    if not os.path.isfile(path):
+        return None
+    try:
+        with open(path, "rb") as bundle_file:
+            index = json.loads(bundle_file.readline())
+            if index["signature"] != get_template_content_signature(get_template_file_names()):
+                print("The template bundle is out of date, reading templates from data instead. Run owcv.py to rebuild it.")
+                return None
+            pixels = np.frombuffer(bundle_file.read(), np.uint8)
+        images = {}
+        stats = {}
+        for image in index["images"]:
+            height, width = image["shape"]
+            images[image["name"]] = pixels[image["offset"]:image["offset"] + height * width].reshape(height, width)
+            if image["stats"] is not None:
+                stats[image["name"]] = np.array(image["stats"])
+        return {file_name: images[file_name] for file_name in file_names}, stats
+    except Exception as bundle_error:
+        print(f"Could not read the template bundle, reading templates from data instead: {bundle_error}")
+        return None
+
+def load_templates(file_names):
+    # Reads templates from the bundle when it's up to date, otherwise from their PNGs
+    bundle = load_template_bundle(file_names)
+    if bundle is not None:
+        return bundle
+    return {file_name: read_template_file(file_name) for file_name in file_names}, {}
+
+def get_window_integrals(image):
+    # Sums fit in 32 bits for any crop of the screen, which OpenCV computes much faster than 64 bit sums
+    return cv.integral2(image, sdepth=cv.CV_32S, sqdepth=cv.CV_64F)
+
+def get_window_energies(window_integrals, height, width):
+    # Sum of squared deviations from the mean of every height x width window, the image's part of the TM_CCOEFF_NORMED denominator
+    window_sums, window_square_sums = window_integrals
+    sums = (window_sums[height:, width:] - window_sums[:-height, width:] - window_sums[height:, :-width] + window_sums[:-height, :-width]).astype(np.float64)
+    square_sums = window_square_sums[height:, width:] - window_square_sums[:-height, width:] - window_square_sums[height:, :-width] + window_square_sums[:-height, :-width]
+    return np.maximum(square_sums - sums * sums / (height * width), 0)
+
 def resolution_to_aspect_ratio_string(horizontal_resolution: int, vertical_resolution: int):
     if (horizontal_resolution, vertical_resolution) in resolutions_21_by_9:
         return "21:9"
     greatest_common_divisor = gcd(horizontal_resolution, vertical_resolution)
     return f"{horizontal_resolution // greatest_common_divisor}:{vertical_resolution // greatest_common_divisor}"
 
+class CoordinateTransform:
+    # Converts between 1080p coords and the user's screen, which may be a different resolution and have black bars
+    def __init__(self, base_resolution, final_resolution):
+        self.base_resolution = base_resolution
+        self.final_resolution = final_resolution
+        width = final_resolution["width"]
+        height = final_resolution["height"]
+        base_aspect_ratio = base_resolution["width"] / base_resolution["height"]
+
+        # The game renders at 16:9, so the rest of a wider or taller screen is black bars
+        if width / height > base_aspect_ratio:
+            self.content_width, self.content_height = round(height * base_aspect_ratio), height
+        else:
+            self.content_width, self.content_height = width, round(width / base_aspect_ratio)
+        self.horizontal_offset = (width - self.content_width) // 2
+        self.vertical_offset = (height - self.content_height) // 2
+        self.content_slice = (
+            slice(self.vertical_offset, self.vertical_offset + self.content_height),
+            slice(self.horizontal_offset, self.horizontal_offset + self.content_width),
+        )
+        self.horizontal_scale = self.content_width / base_resolution["width"]
+        self.vertical_scale = self.content_height / base_resolution["height"]
+        self.identity = final_resolution == base_resolution
+        self.scaled = (self.content_width, self.content_height) != (base_resolution["width"], base_resolution["height"])
+        self.native_regions = {}
+        self.resize_maps = {}
+
+    def to_native(self, region):
+        # Rounds outwards, so the native region always covers everything the 1080p region did
+        key = tuple(region)
+        native_region = self.native_regions.get(key)
+        if native_region is None:
+            native_region = (
+                self.vertical_offset + int(region[0] * self.vertical_scale),
+                self.vertical_offset + min(self.content_height, ceil(region[1] * self.vertical_scale)),
+                self.horizontal_offset + int(region[2] * self.horizontal_scale),
+                self.horizontal_offset + min(self.content_width, ceil(region[3] * self.horizontal_scale)),
+            )
+            self.native_regions[key] = native_region
+        return native_region
+
+    def get_resize_map(self, region):
+        # The part of the screen a 1080p region is resized from when the whole screen is resized, and the affine map from it to the region.
+        # cv.resize samples 1080p pixel x from native x (x + 0.5) * scale - 0.5, which is between native pixels unless the scale is a whole number,
+        # so the crop keeps a pixel on each side to interpolate with, and stops at the edge of the game like the whole-screen resize does.
+        # The map is None when the game is already 1080p and the crop only needs moving.
+        key = tuple(region)
+        resize_map = self.resize_maps.get(key)
+        if resize_map is None:
+            if not self.scaled:
+                native_region = (region[0] + self.vertical_offset, region[1] + self.vertical_offset, region[2] + self.horizontal_offset, region[3] + self.horizontal_offset)
+                resize_map = (native_region, None)
+            else:
+                top = (region[0] + 0.5) * self.vertical_scale - 0.5
+                left = (region[2] + 0.5) * self.horizontal_scale - 0.5
+                crop_top = max(0, floor(top) - 1)
+                crop_bottom = min(self.content_height, ceil((region[1] - 0.5) * self.vertical_scale - 0.5) + 2)
+                crop_left = max(0, floor(left) - 1)
+                crop_right = min(self.content_width, ceil((region[3] - 0.5) * self.horizontal_scale - 0.5) + 2)
+                native_region = (self.vertical_offset + crop_top, self.vertical_offset + crop_bottom, self.horizontal_offset + crop_left, self.horizontal_offset + crop_right)
+                matrix = np.array([[self.horizontal_scale, 0, left - crop_left], [0, self.vertical_scale, top - crop_top]])
+                resize_map = (native_region, matrix)
+            self.resize_maps[key] = resize_map
+        return resize_map
+
+    def scale_image(self, image, interpolation=None):
+        size = (max(1, round(image.shape[1] * self.horizontal_scale)), max(1, round(image.shape[0] * self.vertical_scale)))
+        if interpolation is None:
+            interpolation = cv.INTER_AREA if self.vertical_scale < 1 else cv.INTER_CUBIC
+        return cv.resize(image, size, interpolation=interpolation)
+
+    def get_cache_path(self):
+        return resource_path(os.path.join("cache", f"templates_{self.final_resolution["width"]}x{self.final_resolution["height"]}.npz"))
+
+    def load_scaled_templates(self, templates, masks):
+        # Scaled templates are cached on disk, keyed by resolution, and rebuilt whenever the source templates change
+        signature = get_template_signature([f"t_{key}" for key in templates] + [f"m_{key}" for key in masks])
+        cache_path = self.get_cache_path()
+        if os.path.isfile(cache_path):
+            try:
+                with np.load(cache_path) as cache:
+                    if str(cache["signature"]) == signature:
+                        return (
+                            {key: cache[f"t_{key}"] for key in templates},
+                            {key: cache[f"m_{key}"] for key in masks},
+                        )
+            except Exception as cache_error:
+                print(f"Could not read template cache, rebuilding it: {cache_error}")
+
+        scaled_templates = {key: self.scale_image(template) for key, template in templates.items()}
+        scaled_masks = {key: self.scale_image(mask, cv.INTER_NEAREST) for key, mask in masks.items()}
+        try:
+            os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+            np.savez(
+                cache_path,
+                signature=np.array(signature),
+                **{f"t_{key}": template for key, template in scaled_templates.items()},
+                **{f"m_{key}": mask for key, mask in scaled_masks.items()},
+            )
+        except OSError as cache_error:
+            print(f"Could not save template cache: {cache_error}")
+        return scaled_templates, scaled_masks
+
+
+class TemplatePreFilter:
+    # Rules out a match before running matchTemplate when the crop is completely flat (e.g. a black screen while loading).
+    # Every window of a flat crop scores 0, so skipping it never changes a score. Anything looser isn't safe, as
+    # TM_CCOEFF_NORMED ignores brightness and contrast, so a darkened or faded icon still scores close to 1.
+    def __init__(self):
+        self.checks = 0
+        self.skips = 0
+        self.lock = threading.Lock()
+
+    def can_match(self, cropped_frame):
+        min_value, max_value, _, _ = cv.minMaxLoc(cropped_frame)
+        can_match = max_value > min_value
+        with self.lock:
+            self.checks += 1
+            if not can_match:
+                self.skips += 1
+        return can_match
+
+
+class RegionCache:
+    # Remembers each region's match scores until any of its pixels changes by more than tolerance (0-255).
+    # The largest change is used rather than the mean, as a small icon appearing barely moves the mean of a large region.
+    # Regions are compared against the crop the scores were computed from, so slow drift still invalidates them.
+    def __init__(self, tolerance=0):
+        self.tolerance = tolerance
+        self.entries = {}
+        self.hits = {}
+        self.misses = {}
+        # Detections can run on several threads at once
+        self.lock = threading.Lock()
+
+    def get(self, template_name, region, cropped_frame, frame_index):
+        with self.lock:
+            return self._get(template_name, region, cropped_frame, frame_index)
+
+    def _get(self, template_name, region, cropped_frame, frame_index):
+        entry = self.entries.get(region)
+        if entry is None:
+            entry = self.entries[region] = {"crop": cropped_frame.copy(), "scores": {}, "checked_frame": frame_index}
+        elif entry["checked_frame"] != frame_index:
+            # Only compare the region once per frame, no matter how many templates share it
+            entry["checked_frame"] = frame_index
+            if cv.norm(cropped_frame, entry["crop"], cv.NORM_INF) > self.tolerance:
+                entry["crop"] = cropped_frame.copy()
+                entry["scores"] = {}
+        score = entry["scores"].get(template_name)
+        if score is None:
+            self.misses[template_name] = self.misses.get(template_name, 0) + 1
+        else:
+            self.hits[template_name] = self.hits.get(template_name, 0) + 1
+        return score
+
+    def set(self, template_name, region, score):
+        with self.lock:
+            self.entries[region]["scores"][template_name] = score
+
+    def get_stats(self):
+        return {
+            template_name: {"hits": self.hits.get(template_name, 0), "misses": misses, "hit_rate": self.hits.get(template_name, 0) / (self.hits.get(template_name, 0) + misses)}
+            for template_name, misses in self.misses.items()
+        }
+
+
+class TemplateIndex:
+    # Scores a fixed set of templates against one area of the frame with three matrix products, instead of one matchTemplate per template.
+    # Each template is embedded in the union of the regions at every position it can take in its own region,
+    # so the best score for a label is the same as the best match_batch score of its templates.
+    # labels maps a label (e.g. a hero name) to its template names. templates and regions map template names to images and regions.
+    # masked_labels are the label's templates that have masks, which can't be embedded and are scored separately.
+    def __init__(self, labels, templates, regions, masked_labels=None):
+        self.masked_labels = {} if masked_labels is None else masked_labels
+        self.union = (
+            min(regions[template_name][0] for template_names in labels.values() for template_name in template_names),
+            max(regions[template_name][1] for template_names in labels.values() for template_name in template_names),
+            min(regions[template_name][2] for template_names in labels.values() for template_name in template_names),
+            max(regions[template_name][3] for template_names in labels.values() for template_name in template_names),
+        )
+        union_shape = (self.union[1] - self.union[0], self.union[3] - self.union[2])
+        self.labels = list(labels)
+        zero_mean_rows = []
+        mask_rows = []
+        template_energies = []
+        areas = []
+        row_labels = []
+        for label_index, template_names in enumerate(labels.values()):
+            for template_name in template_names:
+                zero_mean_template, template_energy = get_template_norm(templates[template_name])
+                height, width = zero_mean_template.shape
+                region = regions[template_name]
+                top, left = region[0] - self.union[0], region[2] - self.union[2]
+                for y in range(top, top + max(1, region[1] - region[0] - height + 1)):
+                    for x in range(left, left + max(1, region[3] - region[2] - width + 1)):
+                        zero_mean_row = np.zeros(union_shape)
+                        zero_mean_row[y:y + height, x:x + width] = zero_mean_template
+                        mask_row = np.zeros(union_shape)
+                        mask_row[y:y + height, x:x + width] = 1
+                        zero_mean_rows.append(zero_mean_row.ravel())
+                        mask_rows.append(mask_row.ravel())
+                        template_energies.append(template_energy)
+                        areas.append(height * width)
+                        row_labels.append(label_index)
+        self.zero_mean_templates = np.array(zero_mean_rows)
+        self.masks = np.array(mask_rows)
+        self.template_energies = np.array(template_energies)
+        self.areas = np.array(areas, np.float64)
+        self.row_labels = np.array(row_labels)
+
+    def query(self, frame):
+        # Returns the best score for every label
+        pixels = frame[self.union[0]:self.union[1], self.union[2]:self.union[3]].astype(np.float64).ravel()
+        numerators = self.zero_mean_templates @ pixels
+        sums = self.masks @ pixels
+        square_sums = self.masks @ np.square(pixels)
+        denominators = np.sqrt(np.maximum(square_sums - sums * sums / self.areas, 0) * self.template_energies)
+        # Flat windows can't correlate with anything
+        row_scores = np.divide(numerators, denominators, out=np.zeros_like(denominators), where=denominators > 1e-6)
+        label_scores = np.full(len(self.labels), -1.0)
+        np.maximum.at(label_scores, self.row_labels, row_scores)
+        return dict(zip(self.labels, label_scores.tolist()))
+
+
 class ComputerVision:
-    def __init__(self, coords, mask_names, print_detected_resolution=True):
+    def __init__(self, coords, mask_names, print_detected_resolution=True, frame_source=None, capture_mode="full", capture_regions=None, prefilter=True, cache_tolerance=None):
         self.base_resolution = {"width": 1920, "height": 1080}
         self.base_aspect_ratio = self.base_resolution["width"] / self.base_resolution["height"]
-        self.screen = dxcam_cpp.create(max_buffer_len=1)
+        if frame_source is None:
+            frame_source = DXCamFrameSource()
+        self.screen = frame_source
 
         # Detect the user's screen resolution
         detected_resolution = self.screen.grab().shape[:2]
@@ -47,49 +399,235 @@ class ComputerVision:
             print(f"Detected monitor aspect ratio as {resolution_to_aspect_ratio_string(self.final_resolution["width"], self.final_resolution["height"])}.")
             print(f"Please ensure that your in-game aspect ratio is set to {resolution_to_aspect_ratio_string(self.base_resolution["width"], self.base_resolution["height"])}. If it already is, disregard this message.")
 
-            # Calculate how to crop the screenshots to compensate for the monitor's aspect ratio
-            horizontal_padding = abs(round(
-                (self.final_resolution["width"] - self.base_resolution["width"]) // 2
-            ))
-            vertical_padding = abs(round((
-                self.final_resolution["height"] - self.base_resolution["height"]) // 2
-            ))
-            # Used in screenshot[self.aspect_ratio_crop] to the effect of screenshot[vertical_padding:-vertical_padding, horizontal_padding:-horizontal_padding]
-            self.aspect_ratio_crop = np.ix_([vertical_padding, -vertical_padding], [horizontal_padding, -horizontal_padding])
+        # Maps 1080p coords and templates onto the user's screen
+        self.transform = CoordinateTransform(self.base_resolution, self.final_resolution)
+        # Used in screenshot[self.aspect_ratio_crop] to remove the black bars around the game
+        self.aspect_ratio_crop = self.transform.content_slice
 
         self.screenshot_region = (0, 0, self.final_resolution["width"], self.final_resolution["height"])
         self.coords = coords
-        self.templates = {key: cv.cvtColor(cv.imread(resource_path(f"data\\t_{key}.png")), cv.COLOR_RGB2GRAY) for key in self.coords}
         self.mask_names = mask_names
-        self.masks = {key: cv.cvtColor(cv.imread(resource_path(f"data\\m_{key}.png")), cv.COLOR_RGB2GRAY) for key in self.mask_names}
+        with timings.time("load templates"):
+            images, template_stats = load_templates([f"t_{key}" for key in self.coords] + [f"m_{key}" for key in self.mask_names])
+        self.templates = {key: images[f"t_{key}"] for key in self.coords}
+        self.masks = {key: images[f"m_{key}"] for key in self.mask_names}
+        # Stats for the templates as they're stored, which don't apply once they've been scaled
+        self.template_stats = {key: template_stats.get(f"t_{key}") for key in self.coords}
         self.frame = []
+        self.frame_index = 0
+        # Scores already computed for the current frame, keyed by (template_name, region)
+        self.frame_scores = {}
+        self.frame_time = 0
+        self.capture_time = 0
+
+        # "full" converts the whole screen to a 1080p grayscale frame.
+        # "roi" only converts the regions that are read by detections (coords plus capture_regions) to 1080p, leaving the rest of the frame blank.
+        # "native" is like "roi" without the rescaling, instead matching against templates scaled to the user's resolution.
+        self.capture_mode = capture_mode
+        self.native_detection = self.capture_mode == "native" and not self.transform.identity
+        if self.capture_mode in ("roi", "native"):
+            self.capture_regions = []
+            for region in merge_regions(list(self.coords.values()) + list(capture_regions or [])):
+                if self.native_detection:
+                    native_region = self.transform.to_native(region)
+                    self.capture_regions.append((native_region, None, native_region))
+                else:
+                    # Each region is resized from exactly the pixels the whole-screen resize would use, so it scores the same as in "full"
+                    native_region, resize_matrix = self.transform.get_resize_map(region)
+                    self.capture_regions.append((native_region, resize_matrix, tuple(region)))
+            frame_resolution = self.final_resolution if self.native_detection else self.base_resolution
+            self.frame = np.zeros((frame_resolution["height"], frame_resolution["width"]), np.uint8)
+        if self.native_detection and self.transform.scaled:
+            self.templates, self.masks = self.transform.load_scaled_templates(self.templates, self.masks)
+            self.template_stats = {key: None for key in self.templates}
+        # Zero-mean copies of the templates and their energy, used to score many templates against one crop in match_batch
+        self.template_norms = {key: get_template_norm(template, self.template_stats[key]) for key, template in self.templates.items()}
+        self.prefilters = {}
+        if prefilter:
+            self.prefilters = {key: TemplatePreFilter() for key in self.templates if key not in self.mask_names}
+        # Reuses match scores for regions that haven't changed since the previous frame. None disables it.
+        self.region_cache = None if cache_tolerance is None else RegionCache(cache_tolerance)
 
     def start_capturing(self, target_fps=60):
-        self.screen.start(target_fps=target_fps, video_mode=True)
+        self.screen.start(target_fps=target_fps)
 
     def stop_capturing(self):
         self.screen.stop()
 
     def capture_frame(self):
-        screenshot = self.screen.get_latest_frame()
+        with timings.time("capture"):
+            screenshot = self.screen.get_latest_frame()
+        self.load_frame(screenshot, self.screen.latest_frame_time, self.screen.latest_capture_time)
+
+    def load_frame(self, screenshot, frame_time, capture_time):
+        # Prepares a screenshot for detection. Split from capture_frame so screenshots can be captured on another thread.
+        self.frame_index += 1
+        self.frame_scores = {}
+        self.frame_time = frame_time
+        self.capture_time = capture_time
+        with timings.time("convert"):
+            self.convert_frame(screenshot)
+
+    def convert_frame(self, screenshot):
+        # Crops, rescales and converts a screenshot to grayscale
+        if self.capture_mode in ("roi", "native"):
+            self.capture_roi_frame(screenshot)
+            return
         if self.aspect_ratio_mismatch:
             screenshot = screenshot[self.aspect_ratio_crop]
         if self.resolution_mismatch:
             screenshot = cv.resize(screenshot, (self.base_resolution["width"], self.base_resolution["height"]))
-        self.frame = cv.cvtColor(screenshot, cv.COLOR_BGR2GRAY)
+        if screenshot.ndim == 3:
+            screenshot = cv.cvtColor(screenshot, cv.COLOR_BGR2GRAY)
+        self.frame = screenshot
+
+    def capture_roi_frame(self, screenshot):
+        for native_region, resize_matrix, region in self.capture_regions:
+            roi = screenshot[native_region[0]:native_region[1], native_region[2]:native_region[3]]
+            # Resized before converting to grayscale, in the same order as "full"
+            if resize_matrix is not None:
+                roi = cv.warpAffine(roi, resize_matrix, (region[3] - region[2], region[1] - region[0]), flags=cv.INTER_LINEAR | cv.WARP_INVERSE_MAP, borderMode=cv.BORDER_REPLICATE)
+            if roi.ndim == 3:
+                roi = cv.cvtColor(roi, cv.COLOR_BGR2GRAY)
+            self.frame[region[0]:region[1], region[2]:region[3]] = roi
+
+    def get_region(self, template_name, coords_override=None):
+        region = self.coords[template_name] if coords_override is None else coords_override
+        if self.native_detection:
+            return self.transform.to_native(region)
+        return tuple(region)
 
     def crop(self, image, template_name, coords_override=None):
-        if coords_override is None:
-            return image[self.coords[template_name][0]:self.coords[template_name][1], self.coords[template_name][2]:self.coords[template_name][3]]
-        else:
-            return image[coords_override[0]:coords_override[1], coords_override[2]:coords_override[3]]
+        region = self.get_region(template_name, coords_override)
+        return image[region[0]:region[1], region[2]:region[3]]
 
     def match(self, template_name, coords_override=None):
         cropped_frame = self.crop(self.frame, template_name, coords_override)
-        if template_name in self.mask_names:
-            return cv.matchTemplate(cropped_frame, self.templates[template_name], cv.TM_CCOEFF_NORMED, mask=self.masks[template_name])
-        else:
-            return cv.matchTemplate(cropped_frame, self.templates[template_name], cv.TM_CCOEFF_NORMED)
+        with timings.time(f"match {template_name}"):
+            if template_name in self.mask_names:
+                return cv.matchTemplate(cropped_frame, self.templates[template_name], cv.TM_CCOEFF_NORMED, mask=self.masks[template_name])
+            else:
+                return cv.matchTemplate(cropped_frame, self.templates[template_name], cv.TM_CCOEFF_NORMED)
+
+    def match_batch(self, template_names, coords_overrides=None):
+        # Scores several templates in one pass over the union of their regions, returning the best score for each template.
+        # The crop is converted and its window statistics (the TM_CCOEFF_NORMED denominator) are computed once per template size,
+        # so each extra template only costs one correlation. A single template is left to matchTemplate, as there's nothing to share.
+        if coords_overrides is None:
+            coords_overrides = {}
+        regions = {}
+        scores = {}
+        for template_name in template_names:
+            region = self.get_region(template_name, coords_overrides.get(template_name))
+            cached_score = self._get_cached_score(template_name, region)
+            if cached_score is None:
+                regions[template_name] = region
+            else:
+                scores[template_name] = cached_score
+        if not regions:
+            return scores
+
+        union = (
+            min(region[0] for region in regions.values()),
+            max(region[1] for region in regions.values()),
+            min(region[2] for region in regions.values()),
+            max(region[3] for region in regions.values()),
+        )
+        cropped_frame = self.frame[union[0]:union[1], union[2]:union[3]]
+        cropped_frame_float = None
+        window_energies = {}
+        for template_name, region in regions.items():
+            match_start_time = time.perf_counter()
+            top, bottom, left, right = region[0] - union[0], region[1] - union[0], region[2] - union[2], region[3] - union[2]
+            if template_name in self.prefilters and not self.prefilters[template_name].can_match(cropped_frame[top:bottom, left:right]):
+                scores[template_name] = 0.0
+            elif template_name in self.mask_names:
+                result = cv.matchTemplate(cropped_frame[top:bottom, left:right], self.templates[template_name], cv.TM_CCOEFF_NORMED, mask=self.masks[template_name])
+                scores[template_name] = float(np.nanmax(result))
+            elif len(regions) == 1:
+                # With one template there are no window statistics to share, and matchTemplate normalizes faster on its own
+                result = cv.matchTemplate(cropped_frame[top:bottom, left:right], self.templates[template_name], cv.TM_CCOEFF_NORMED)
+                scores[template_name] = float(result.max())
+            else:
+                if cropped_frame_float is None:
+                    cropped_frame_float = cropped_frame.astype(np.float32)
+                    window_integrals = get_window_integrals(cropped_frame)
+                zero_mean_template, template_energy = self.template_norms[template_name]
+                height, width = zero_mean_template.shape
+                if (height, width) not in window_energies:
+                    window_energies[(height, width)] = get_window_energies(window_integrals, height, width)
+                window_energy = window_energies[(height, width)][top:bottom - height + 1, left:right - width + 1]
+
+                numerator = cv.matchTemplate(cropped_frame_float[top:bottom, left:right], zero_mean_template, cv.TM_CCORR)
+                denominator = np.sqrt(window_energy * template_energy)
+                # Flat windows can't correlate with anything
+                result = np.divide(numerator, denominator, out=np.zeros_like(denominator), where=denominator > 1e-6)
+                scores[template_name] = float(result.max())
+            self._cache_score(template_name, region, scores[template_name])
+            timings.add_since(f"match {template_name}", match_start_time)
+        return scores
+
+    def scan_rows(self, template_names, row_regions, threshold=None):
+        # Scores templates on the rows of a column (like the kill feed) from the top row down. The whole column is converted
+        # and integrated once, then each row's region is correlated with each template.
+        # With a threshold, the first template (in template_names order) above it wins its row, so the rest aren't scored,
+        # and the scan stops after the first row where none are.
+        # row_regions maps each template name to its region on each row, from top to bottom.
+        # Returns one {template_name: (score, y)} per scanned row, y being the frame row the template's best match starts at.
+        regions = {template_name: [self.get_region(template_name, region) for region in row_regions[template_name]] for template_name in template_names}
+        column = (
+            min(template_regions[0][0] for template_regions in regions.values()),
+            max(template_regions[-1][1] for template_regions in regions.values()),
+            min(region[2] for template_regions in regions.values() for region in template_regions),
+            max(region[3] for template_regions in regions.values() for region in template_regions),
+        )
+        cropped_frame = self.frame[column[0]:column[1], column[2]:column[3]]
+        cropped_frame_float = None
+        window_energies = {}
+        rows = []
+        for row in range(len(next(iter(regions.values())))):
+            row_scores = {}
+            rows.append(row_scores)
+            for template_name in template_names:
+                match_start_time = time.perf_counter()
+                region = regions[template_name][row]
+                top, bottom, left, right = region[0] - column[0], region[1] - column[0], region[2] - column[2], region[3] - column[2]
+                height, width = self.templates[template_name].shape
+                score = self._get_cached_score(template_name, region)
+                if score is not None:
+                    # Cached scores don't keep their position, which is the top of the region when the template is as tall as it
+                    row_scores[template_name] = (score, region[0])
+                elif template_name in self.prefilters and not self.prefilters[template_name].can_match(cropped_frame[top:bottom, left:right]):
+                    row_scores[template_name] = (0.0, region[0])
+                else:
+                    if template_name in self.mask_names:
+                        result = cv.matchTemplate(cropped_frame[top:bottom, left:right], self.templates[template_name], cv.TM_CCOEFF_NORMED, mask=self.masks[template_name])
+                        result = np.nan_to_num(result, nan=-1.0)
+                    else:
+                        # Same scoring as match_batch, so a row scores the same whichever way it's detected
+                        if cropped_frame_float is None:
+                            cropped_frame_float = cropped_frame.astype(np.float32)
+                            window_integrals = get_window_integrals(cropped_frame)
+                        zero_mean_template, template_energy = self.template_norms[template_name]
+                        # Only the windows inside the row are needed, not the ones straddling the gaps between rows
+                        if (region, height, width) not in window_energies:
+                            window_energies[(region, height, width)] = get_window_energies([integral[top:bottom + 1, left:right + 1] for integral in window_integrals], height, width)
+                        window_energy = window_energies[(region, height, width)]
+                        numerator = cv.matchTemplate(cropped_frame_float[top:bottom, left:right], zero_mean_template, cv.TM_CCORR)
+                        denominator = np.sqrt(window_energy * template_energy)
+                        result = np.divide(numerator, denominator, out=np.zeros_like(denominator), where=denominator > 1e-6)
+                    peak_y = int(np.argmax(result)) // result.shape[1]
+                    row_scores[template_name] = (float(result.max()), region[0] + peak_y)
+                    self._cache_score(template_name, region, row_scores[template_name][0])
+                timings.add_since(f"match {template_name}", match_start_time)
+                if threshold is not None and row_scores[template_name][0] > threshold:
+                    break
+            if threshold is not None and all(score <= threshold for score, _ in row_scores.values()):
+                break
+        return rows
+
+    def detect_batch(self, template_names, threshold=0.9, coords_overrides=None):
+        return {template_name: score > threshold for template_name, score in self.match_batch(template_names, coords_overrides).items()}
 
     def detect_multiple(self, template_name, threshold=0.9):
         result = self.match(template_name)
@@ -97,5 +635,67 @@ class ComputerVision:
         return len(cv.findContours(result.astype(np.uint8), cv.RETR_LIST, cv.CHAIN_APPROX_SIMPLE)[0])
 
     def detect_single(self, template_name, threshold=0.9, coords_override=None):
-        result = self.match(template_name, coords_override)
-        return np.nanmax(result) > threshold
+        # Goes through match_batch so cached and prefetched scores are picked up. A lone template is scored by matchTemplate.
+        coords_overrides = None if coords_override is None else {template_name: coords_override}
+        return self.match_batch([template_name], coords_overrides)[template_name] > threshold
+
+    def build_template_index(self, labels):
+        # Masked templates can't be embedded in the index, so classify scores them with match_batch
+        index_labels = {}
+        masked_labels = {}
+        for label, template_names in labels.items():
+            index_labels[label] = [template_name for template_name in template_names if template_name not in self.mask_names]
+            masked_labels[label] = [template_name for template_name in template_names if template_name in self.mask_names]
+        regions = {template_name: self.get_region(template_name) for template_names in labels.values() for template_name in template_names}
+        return TemplateIndex({label: template_names for label, template_names in index_labels.items() if template_names}, self.templates, regions, masked_labels)
+
+    def classify(self, index, threshold=0.9):
+        # Returns the label with the best score above threshold (or None) and that score, which doubles as the confidence
+        with timings.time("match template index"):
+            scores = index.query(self.frame)
+        for label, template_names in index.masked_labels.items():
+            if template_names:
+                scores[label] = max([scores.get(label, -1.0)] + list(self.match_batch(template_names).values()))
+        best_label = max(scores, key=scores.get)
+        if scores[best_label] > threshold:
+            return best_label, scores[best_label]
+        return None, scores[best_label]
+
+    def prefetch(self, jobs, executor):
+        # Scores independent (template_names, coords_overrides) jobs on a thread pool. OpenCV releases the GIL while matching,
+        # so the jobs run concurrently. Scores are kept for the rest of the frame, where detect_single and match_batch pick them up.
+        futures = [executor.submit(self.match_batch, template_names, coords_overrides) for template_names, coords_overrides in jobs]
+        for future in futures:
+            future.result()
+
+    def _get_cached_score(self, template_name, region):
+        score = self.frame_scores.get((template_name, region))
+        if score is not None or self.region_cache is None:
+            return score
+        return self.region_cache.get(template_name, region, self.frame[region[0]:region[1], region[2]:region[3]], self.frame_index)
+
+    def _cache_score(self, template_name, region, score):
+        self.frame_scores[(template_name, region)] = score
+        if self.region_cache is not None:
+            self.region_cache.set(template_name, region, score)
+
+    def get_prefilter_stats(self):
+        return {
+            template_name: {"checks": prefilter.checks, "skips": prefilter.skips, "skip_rate": prefilter.skips / prefilter.checks if prefilter.checks else 0}
+            for template_name, prefilter in self.prefilters.items()
+        }
+
+    def print_prefilter_stats(self):
+        for template_name, stats in self.get_prefilter_stats().items():
+            if stats["checks"]:
+                print(f"  {template_name}: skipped {stats['skips']}/{stats['checks']} matches ({round(100 * stats['skip_rate'], 1)}%)")
+
+    def print_region_cache_stats(self):
+        for template_name, stats in self.region_cache.get_stats().items():
+            print(f"  {template_name}: {stats['hits']} hits, {stats['misses']} misses ({round(100 * stats['hit_rate'], 1)}% hit rate)")
+
+
+if __name__ == "__main__":
+    # The build step for the template bundle, e.g. before packaging OverStim
+    bundled_file_names = build_template_bundle()
+    print(f"Packed {len(bundled_file_names)} templates and masks into {get_template_bundle_path()}.")
@@ -1,11 +1,134 @@
+from concurrent.futures import ThreadPoolExecutor
 import time
 
 from owcv import ComputerVision
+from detectionplan import DetectionPlan
+from timing import timings
 import heroes
 
 
+# Coords are for the first row
+all_notif_coords = {
+    "elimination": [751, 779, 833, 975],
+    "assist": [751, 779, 833, 975],
+    "save": [751, 779, 729, 923],
+}
+notif_row_count = 2 # Overridden by config.ini
+notif_row_spacing = 35 # Pixels between rows @ 1080p
+
+
+def get_notif_coords(notif_type, row):
+    notif_coords = list(all_notif_coords[notif_type])
+    notif_coords[0] += row * notif_row_spacing
+    notif_coords[1] += row * notif_row_spacing
+    return notif_coords
+
+
+class Detector:
+    # rate: target runs per second (of frame time), or None to run every frame.
+    # priority: detectors run in descending priority order, and lower priority ones are deferred first when a frame is over budget.
+    # get_jobs returns the (template_names, coords_overrides) jobs the detector's detections can be prefetched as.
+    def __init__(self, name, run, rate=None, priority=0, while_dead=False, get_jobs=None):
+        self.name = name
+        self.run = run
+        self.rate = rate
+        self.priority = priority
+        self.while_dead = while_dead
+        self.get_jobs = get_jobs
+        self.due_time = None # None means due now without having missed a deadline
+        self.runs = 0
+        self.misses = 0
+        self.deferrals = 0
+        self.max_lateness = 0
+        self.first_run_time = None
+        self.last_run_time = None
+
+
+class DetectorScheduler:
+    # Runs each detector at its own rate. A detector that runs more than a whole period after it was due has missed a deadline.
+    def __init__(self, frame_budget=None):
+        self.frame_budget = frame_budget # Seconds of detection per frame before rate limited detectors are deferred
+        self.detectors = []
+        self.frame_start_time = 0
+
+    def add(self, detector):
+        self.detectors.append(detector)
+        self.detectors.sort(key=lambda scheduled_detector: scheduled_detector.priority, reverse=True)
+
+    def set_rates(self, rates):
+        # A rate of 0 runs the detector every frame
+        for detector in self.detectors:
+            if detector.name in rates:
+                detector.rate = rates[detector.name] or None
+                detector.due_time = None
+
+    def start_frame(self):
+        self.frame_start_time = time.perf_counter()
+
+    def get_due(self, current_time, while_dead=False):
+        return [
+            detector for detector in self.detectors
+            if detector.while_dead == while_dead and (detector.rate is None or detector.due_time is None or current_time >= detector.due_time)
+        ]
+
+    def run(self, detectors, current_time):
+        for detector in detectors:
+            if self.frame_budget is not None and self._can_defer(detector, current_time) and time.perf_counter() - self.frame_start_time >= self.frame_budget:
+                detector.deferrals += 1
+                continue
+            with timings.time(f"detector {detector.name}"):
+                detector.run()
+            self._update_deadline(detector, current_time)
+
+    def _can_defer(self, detector, current_time):
+        # Detectors without a rate always run, and a detector is never put off for so long that it would miss a deadline
+        if detector.rate is None or detector.due_time is None:
+            return False
+        return current_time - detector.due_time < 1 / detector.rate
+
+    def pause(self, while_dead=False):
+        # Detectors that can't run (e.g. while the player is dead) are due as soon as they can, without counting the gap as missed
+        for detector in self.detectors:
+            if detector.while_dead == while_dead:
+                detector.due_time = None
+
+    def _update_deadline(self, detector, current_time):
+        detector.runs += 1
+        if detector.first_run_time is None:
+            detector.first_run_time = current_time
+        detector.last_run_time = current_time
+        if detector.rate is None:
+            return
+        period = 1 / detector.rate
+        if detector.due_time is None:
+            detector.due_time = current_time + period
+            return
+        lateness = current_time - detector.due_time
+        detector.max_lateness = max(detector.max_lateness, lateness)
+        if lateness >= period:
+            detector.misses += 1
+            detector.due_time = current_time + period
+        else:
+            # Keeps the average rate on target when frames don't line up with the period
+            detector.due_time += period
+
+    def get_stats(self):
+        stats = {}
+        for detector in self.detectors:
+            duration = 0 if detector.first_run_time is None else detector.last_run_time - detector.first_run_time
+            stats[detector.name] = {
+                "target_rate": detector.rate,
+                "rate": (detector.runs - 1) / duration if duration > 0 else 0,
+                "runs": detector.runs,
+                "misses": detector.misses,
+                "deferrals": detector.deferrals,
+                "max_lateness": detector.max_lateness,
+            }
+        return stats
+
+
 class OverwatchStateTracker:
-    def __init__(self):
+    def __init__(self, frame_source=None, capture_mode="full", prefilter=True, cache_tolerance=None, detection_workers=0, detection_plan=None, detector_rates=None, frame_budget=None, notif_rows=notif_row_count):
         coords = {
             "elimination": [751, 779, 833, 975],
             "assist": [751, 779, 833, 975],
@@ -38,8 +161,15 @@ class OverwatchStateTracker:
         }
         to_mask = [
         ]
-        self.owcv = ComputerVision(coords, to_mask)
+        # The kill feed is scanned as one column of notif_rows rows
+        self.notif_rows = notif_rows
+        notif_regions = [get_notif_coords(notif_type, row) for notif_type in all_notif_coords for row in range(self.notif_rows)]
+        self.owcv = ComputerVision(coords, to_mask, frame_source=frame_source, capture_mode=capture_mode, capture_regions=notif_regions, prefilter=prefilter, cache_tolerance=cache_tolerance)
         self.current_time = 0
+        # Wall clock time the current frame was captured, which vibes trace their latency from
+        self.trace_time = 0
+        # Only detections that can affect the output are run
+        self.plan = DetectionPlan() if detection_plan is None else detection_plan
         self.supported_heroes = {
             "Baptiste": heroes.Baptiste(),
             "Brigitte": heroes.Brigitte(),
@@ -49,30 +179,71 @@ class OverwatchStateTracker:
             "Mercy": heroes.Mercy(),
             "Zenyatta": heroes.Zenyatta()
         }
+        # With detection workers, independent detections for each frame run on a thread pool before the state is updated
+        self.detection_workers = detection_workers
+        self.executor = None
+        # Identifies the hero from all weapon icons at once
+        self.hero_index = self.owcv.build_template_index({name: hero.weapons for name, hero in self.supported_heroes.items()})
         self.hero = heroes.Other()
         self.detected_hero = "Other"
+        self.detected_hero_confidence = 0
         self.detected_hero_time = 0
-        self.last_hero_detection_attempt_time = 0
         self.hero_auto_detect = True
         self.in_killcam = False
         self.death_spectating = False
         self.is_dead = False
         self.notifs = []
         self.new_notifs = {}
+        self.notif_positions = []
         self.being_beamed = False
         self.being_orbed = False
         self.hacked = False
+        self.scheduler = DetectorScheduler(frame_budget)
+        self.add_detectors()
+        if detector_rates is not None:
+            self.scheduler.set_rates(detector_rates)
+
+    def add_detectors(self):
+        # Hero detection runs once per second, as it did before detectors were scheduled, and everything else every frame, unless DETECTOR_RATES
+        # says otherwise. They run in the same order as before too: notifs come before abilities because Mercy's resurrect check reads this frame's saves.
+        self.scheduler.add(Detector("life", self.detect_life, priority=100, while_dead=True, get_jobs=lambda: [(["killcam"], None), (["death_spec"], None)]))
+        if self.plan.is_enabled("elimination"):
+            self.scheduler.add(Detector("notifs", self.detect_new_notifs, priority=90))
+        for template_name in ["being_beamed", "being_orbed", "hacked"]:
+            if self.plan.is_enabled(template_name):
+                self.scheduler.add(Detector(template_name, lambda template_name=template_name: self.detect_status(template_name), priority=80, get_jobs=lambda template_name=template_name: [([template_name], None)]))
+        self.scheduler.add(Detector("abilities", self.detect_abilities, priority=70, get_jobs=lambda: [([template_name], None) for template_name in self.plan.filter(self.hero.ability_templates)]))
+        self.scheduler.add(Detector("hero", self.detect_current_hero, rate=1, priority=10))
 
-    def refresh(self, capture_frame_only=False):
-        self.owcv.capture_frame()
+    def refresh(self, capture_frame_only=False, frame=None):
+        # frame is an already captured (screenshot, frame_time, capture_time), otherwise a new one is captured
+        if frame is None:
+            self.owcv.capture_frame()
+        else:
+            self.owcv.load_frame(*frame)
         if capture_frame_only:
             return
 
-        # TODO: Shouldn't check for things that aren't enabled in the config
-        self.current_time = time.time()
+        # Frame time follows the wall clock when live, and the recording when replaying
+        self.current_time = self.owcv.frame_time
+        self.trace_time = self.owcv.capture_time
         self.expire_notifs()
         self.new_notifs = {}
 
+        # Whether the player is alive decides if anything else is worth checking, so it's run first
+        self.scheduler.start_frame()
+        self.run_detectors(self.scheduler.get_due(self.current_time, while_dead=True))
+        if self.is_dead:
+            self.scheduler.pause()
+        else:
+            self.run_detectors(self.scheduler.get_due(self.current_time))
+
+    def run_detectors(self, detectors):
+        if self.executor is not None:
+            self.owcv.prefetch([job for detector in detectors if detector.get_jobs is not None for job in detector.get_jobs()], self.executor)
+        self.scheduler.run(detectors, self.current_time)
+
+    def detect_life(self):
         # TODO: Find out if the player is alive (there is a period of time between death and killcam, should handle that with "you were eliminated" message and a timer)
         self.in_killcam = self.owcv.detect_single("killcam")
         if not self.in_killcam:
@@ -83,39 +254,6 @@ class OverwatchStateTracker:
             if self.is_dead:
                 self.is_dead = False
 
-            self.detect_new_notifs()
-
-            self.being_beamed = self.owcv.detect_single("being_beamed")
-
-            self.being_orbed = self.owcv.detect_single("being_orbed")
-
-            self.hacked = self.owcv.detect_single("hacked")
-
-            if self.hero.name == "Other":
-                pass
-            elif self.hero.name == "Mercy":
-                self.hero.detect_beams(self.owcv)
-                if self.count_notifs_of_type("save") > 0: # Could we use self.new_notifs here or is rez icon too delayed?
-                    self.hero.detect_resurrect(self.owcv)
-            else:
-                self.hero.detect_all(self.owcv)
-
-            if self.hero_auto_detect:
-                # Check for current hero once per second.
-                # If not found after 3 seconds, check for every hero each second (starting with heroes in the same role).
-                # If not found after 6 seconds (total), switch to Other.
-                time_since_successful_hero_detection = self.current_time - self.detected_hero_time
-                time_since_attempted_hero_detection = self.current_time - self.last_hero_detection_attempt_time
-                if time_since_attempted_hero_detection >= 1:
-                    if self.hero.name == "Other":
-                        if time_since_attempted_hero_detection >= 2:
-                            self.detect_hero() # Detect all heroes
-                    else:
-                        if time_since_successful_hero_detection >= 4:
-                            self.detect_hero(prioritize_current_role=True) # Detect all heroes, starting with same role
-                        else:
-                            self.detect_hero(current_hero_only=True) # Detect just self.hero
-
         # If player is dead:
         else:
             if not self.is_dead:
@@ -125,28 +263,43 @@ class OverwatchStateTracker:
                 self.hacked = False
                 self.hero.reset_attributes()
 
-    def detect_hero(self, current_hero_only=False, prioritize_current_role=False):
-        hero_detected = False
-        if current_hero_only:
-            if self.hero.detect_hero(self.owcv):
-                self.detected_hero_time = self.current_time
-                hero_detected = True
-        else:
-            if prioritize_current_role:
-                heroes_to_detect = self.get_supported_heroes_prioritizing_current_role()
-            else:
-                heroes_to_detect = self.supported_heroes
-            for hero in heroes_to_detect.values():
-                if hero.detect_hero(self.owcv):
-                    self.detected_hero = hero.name
-                    self.detected_hero_time = self.current_time
-                    hero_detected = True
-                    break
-        # If no supported hero has been detected within the last 8 seconds:
+    def detect_status(self, template_name):
+        # being_beamed, being_orbed and hacked are stored under their template names
+        setattr(self, template_name, self.owcv.detect_single(template_name))
+
+    def detect_abilities(self):
+        if self.hero.name == "Other":
+            return
+        self.hero.detect_all(self.owcv, self.plan)
+        if self.hero.name == "Mercy" and self.plan.is_enabled("mercy_resurrect_cd"):
+            if self.count_notifs_of_type("save") > 0: # Could we use self.new_notifs here or is rez icon too delayed?
+                self.hero.detect_resurrect(self.owcv)
+
+    def detect_current_hero(self):
+        # Runs once per second (by default)
+        if self.hero_auto_detect:
+            self.detect_hero()
+
+    def get_detector_stats(self):
+        return self.scheduler.get_stats()
+
+    def print_detector_stats(self):
+        for name, stats in self.get_detector_stats().items():
+            target = "every frame" if stats["target_rate"] is None else f"target {stats['target_rate']}/s"
+            print(f"  {name}: {stats['runs']} runs ({round(stats['rate'], 2)}/s, {target}), {stats['misses']} missed deadlines, {stats['deferrals']} deferred, max {round(1000 * stats['max_lateness'], 1)}ms late")
+
+    def detect_hero(self):
+        # Every supported hero is checked in one query, the best weapon match above the threshold wins
+        hero_name, confidence = self.owcv.classify(self.hero_index, threshold=0.97)
+        if hero_name is not None:
+            self.detected_hero = hero_name
+            self.detected_hero_confidence = confidence
+            self.detected_hero_time = self.current_time
+        # If no supported hero has been detected within the last 6 seconds:
         time_since_successful_hero_detection = self.current_time - self.detected_hero_time
-        if not hero_detected and self.detected_hero != "Other" and time_since_successful_hero_detection >= 6:
+        if hero_name is None and self.detected_hero != "Other" and time_since_successful_hero_detection >= 6:
             self.detected_hero = "Other"
-        self.last_hero_detection_attempt_time = self.current_time
+            self.detected_hero_confidence = 0
 
     def switch_hero(self, hero_name):
         self.hero.reset_attributes()
@@ -156,28 +309,16 @@ class OverwatchStateTracker:
             self.hero = self.supported_heroes[hero_name]
 
     def detect_new_notifs(self):
-        # Coords are for the first row
-        all_notif_coords = {
-            "elimination": [751, 779, 833, 975],
-            "assist": [751, 779, 833, 975],
-            "save": [751, 779, 729, 923],
-        }
-
+        # Reads the kill feed from the top row down in one scan, returning the detected (notif_type, y) of each row
+        notif_regions = {notif_type: [get_notif_coords(notif_type, row) for row in range(self.notif_rows)] for notif_type in all_notif_coords}
         notifs = {}
-        for row in range(0, 2):
-            pixel_offset = row * 35 # Pixels between rows @ 1080p
-            no_notif_detected = True
-            for notif_type, notif_coords in all_notif_coords.items():
-                notif_coords[0] += pixel_offset
-                notif_coords[1] += pixel_offset
-                if self.owcv.detect_single(notif_type, coords_override=notif_coords):
-                    no_notif_detected = False
+        self.notif_positions = []
+        # The first type detected on a row (in all_notif_coords order) wins, and the feed ends at the first empty row
+        for row_scores in self.owcv.scan_rows(list(all_notif_coords), notif_regions, threshold=0.9):
+            for notif_type, (score, y) in row_scores.items():
+                if score > 0.9:
                     notifs[notif_type] = notifs.get(notif_type, 0) + 1
-                    # If a notif was detected on this row, no need to check for other notifs on this row
-                    break
-            # If no notif was detected on this row, no need to check the next row
-            if no_notif_detected:
-                break
+                    self.notif_positions.append((notif_type, y))
         
         for notif_type, notifs_detected in notifs.items():
             existing_notifs = self.count_notifs_of_type(notif_type)
@@ -185,7 +326,8 @@ class OverwatchStateTracker:
             for _ in range(new_notifs):
                 self.add_notif(notif_type)
             self.new_notifs[notif_type] = new_notifs
-    
+        return self.notif_positions
+
     def count_notifs_of_type(self, notif_type):
         return sum(notif[0] == notif_type for notif in self.notifs)
 
@@ -203,19 +345,18 @@ class OverwatchStateTracker:
             self.notifs.remove(expired_notif)
 
     def add_notif(self, notif_type):
-        if len(self.notifs) == 3:
+        # There can't be more notifs on screen than rows in the feed
+        if len(self.notifs) >= self.notif_rows:
             del self.notifs[0]
         self.notifs.append([notif_type, self.current_time + 2.705])
 
     def start_tracking(self, refresh_rate):
+        if self.detection_workers > 0:
+            self.executor = ThreadPoolExecutor(max_workers=self.detection_workers, thread_name_prefix="detection")
         self.owcv.start_capturing(refresh_rate)
 
     def stop_tracking(self):
         self.owcv.stop_capturing()
-
-    def get_supported_heroes_prioritizing_current_role(self):
-        current_role_heroes = {name: hero for name, hero in self.supported_heroes.items() if hero.role == self.hero.role}
-        other_heroes = {name: hero for name, hero in self.supported_heroes.items() if hero.role != self.hero.role}
-        sorted_heroes = {**current_role_heroes, **other_heroes}
-
-        return sorted_heroes
\ No newline at end of file
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
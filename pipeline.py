@@ -0,0 +1,184 @@
+import threading
+import copy
+import time
+
+from framesources import ReplayFinished
+from timing import timings
+
+
+class StageStats:
+    def __init__(self, name):
+        self.name = name
+        self.processed = 0
+        self.dropped = 0
+        self.start_time = time.time()
+
+    def get_throughput(self):
+        duration = time.time() - self.start_time
+        return self.processed / duration if duration > 0 else 0
+
+    def __str__(self):
+        return f"{self.name}: {self.processed} processed ({round(self.get_throughput(), 2)}/s), {self.dropped} dropped"
+
+
+class LatestValueBuffer:
+    # Holds only the newest value. Values that are replaced before anyone takes them are counted as dropped.
+    def __init__(self, stats):
+        self.stats = stats
+        self.condition = threading.Condition()
+        self.value = None
+
+    def put(self, value, merge=None):
+        with self.condition:
+            if self.value is not None:
+                self.stats.dropped += 1
+                if merge is not None:
+                    merge(self.value, value)
+            self.value = value
+            self.condition.notify()
+
+    def wait(self, timeout=None):
+        # Waits for a value without taking it, returning whether there is one
+        with self.condition:
+            if self.value is None and timeout != 0:
+                self.condition.wait(timeout)
+            return self.value is not None
+
+    def take(self, timeout=None):
+        with self.condition:
+            if self.value is None and timeout != 0:
+                self.condition.wait(timeout)
+            value = self.value
+            self.value = None
+            return value
+
+
+class StateSnapshot:
+    # A copy of the parts of OverwatchStateTracker that triggers read, safe to use while detection carries on
+    def __init__(self, player, previous_hero=None):
+        self.frame_time = player.owcv.frame_time
+        self.capture_time = player.owcv.capture_time
+        self.trace_time = player.trace_time
+        self.in_killcam = player.in_killcam
+        self.death_spectating = player.death_spectating
+        self.is_dead = player.is_dead
+        self.new_notifs = dict(player.new_notifs)
+        self.being_beamed = player.being_beamed
+        self.being_orbed = player.being_orbed
+        self.hacked = player.hacked
+        self.hero_auto_detect = player.hero_auto_detect
+        self.detected_hero = player.detected_hero
+        self.detected_hero_confidence = player.detected_hero_confidence
+        self.hero = copy.copy(player.hero)
+        # Set when the detection stage switched hero automatically, so the consumer can clear the old hero's vibes
+        self.previous_hero = previous_hero
+
+    def merge_into(self, newer_snapshot):
+        # Notifs from a snapshot that was never consumed still need to trigger vibes
+        for notif_type, count in self.new_notifs.items():
+            newer_snapshot.new_notifs[notif_type] = newer_snapshot.new_notifs.get(notif_type, 0) + count
+        # Their latency counts from the frame they were first seen on
+        if self.new_notifs:
+            newer_snapshot.trace_time = min(newer_snapshot.trace_time, self.trace_time)
+        if newer_snapshot.previous_hero is None:
+            newer_snapshot.previous_hero = self.previous_hero
+
+
+class DetectionPipeline:
+    # Runs capture and detection on their own threads, so a slow GUI redraw or device write doesn't delay detection.
+    # capture thread -> latest frame buffer -> detection thread -> latest snapshot buffer -> asyncio consumer
+    def __init__(self, player, refresh_rate, dead_refresh_rate):
+        self.player = player
+        self.refresh_rate = refresh_rate
+        self.dead_refresh_rate = dead_refresh_rate
+        self.capture_stats = StageStats("Capture")
+        self.detection_stats = StageStats("Detection")
+        self.consumer_stats = StageStats("Triggers")
+        self.frames = LatestValueBuffer(self.capture_stats)
+        self.snapshots = LatestValueBuffer(self.detection_stats)
+        self.running = False
+        self.finished = False
+        self.error = None
+        self.pending_hero = None
+        self.hero_lock = threading.Lock()
+        self.threads = []
+
+    def start(self):
+        self.running = True
+        self.player.start_tracking(self.refresh_rate)
+        for stats in (self.capture_stats, self.detection_stats, self.consumer_stats):
+            stats.start_time = time.time()
+        self.threads = [
+            threading.Thread(target=self._run_stage, args=(self._capture,), name="capture", daemon=True),
+            threading.Thread(target=self._run_stage, args=(self._detect,), name="detection", daemon=True),
+        ]
+        for thread in self.threads:
+            thread.start()
+
+    def stop(self):
+        self.running = False
+        for thread in self.threads:
+            thread.join(timeout=1)
+        self.player.stop_tracking()
+
+    def switch_hero(self, hero_name):
+        # Applied by the detection thread before its next frame
+        with self.hero_lock:
+            self.pending_hero = hero_name
+
+    def get_snapshot(self, timeout=0):
+        # Returns the newest state snapshot, or None if there hasn't been a new one since the last call
+        if self.error is not None:
+            raise self.error
+        snapshot = self.snapshots.take(timeout)
+        if snapshot is not None:
+            self.consumer_stats.processed += 1
+        return snapshot
+
+    def wait_for_snapshot(self, timeout):
+        # Lets the consumer sleep until detection has something new, instead of polling get_snapshot
+        return self.snapshots.wait(timeout)
+
+    def get_stats(self):
+        return [self.capture_stats, self.detection_stats, self.consumer_stats]
+
+    def _run_stage(self, stage):
+        try:
+            stage()
+        except ReplayFinished:
+            self.finished = True
+        except Exception as stage_error:
+            self.error = stage_error
+        self.running = False
+
+    def _capture(self):
+        screen = self.player.owcv.screen
+        while self.running:
+            with timings.time("capture"):
+                screenshot = screen.get_latest_frame()
+            self.frames.put((screenshot, screen.latest_frame_time, screen.latest_capture_time))
+            self.capture_stats.processed += 1
+
+    def _detect(self):
+        last_refresh = 0
+        while self.running or self.frames.value is not None:
+            frame = self.frames.take(timeout=0.1)
+            if frame is None:
+                continue
+            with self.hero_lock:
+                if self.pending_hero is not None:
+                    self.player.switch_hero(self.pending_hero)
+                    self.pending_hero = None
+
+            # Frames that arrive while the player is dead are only checked at the dead refresh rate
+            if self.player.is_dead and frame[1] < last_refresh + (1 / float(self.dead_refresh_rate)):
+                continue
+            last_refresh = frame[1]
+            self.player.refresh(frame=frame)
+
+            previous_hero = None
+            if self.player.hero_auto_detect and self.player.detected_hero != self.player.hero.name:
+                previous_hero = self.player.hero.name
+                self.player.switch_hero(self.player.detected_hero)
+            self.snapshots.put(StateSnapshot(self.player, previous_hero), merge=StateSnapshot.merge_into)
+            self.detection_stats.processed += 1
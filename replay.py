@@ -0,0 +1,213 @@
+import argparse
+import asyncio
+import configparser
+import json
+import time
+import sys
+
+from framesources import ReplayFrameSource, ReplayFinished
+from owstate import OverwatchStateTracker
+from pipeline import DetectionPipeline
+from detectionplan import DetectionPlan
+from timing import timings
+from eventlog import event_log
+from triggers import Triggers
+from vibes import VibeManager
+from devices import DeviceOutputs
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Run OverStim's detection against a recorded match and report its performance.")
+    parser.add_argument("source", help="Directory of screenshots, video file or .npy stack of frames")
+    parser.add_argument("--rate", type=float, default=None, help="Frames per second to replay at (default: as fast as possible)")
+    parser.add_argument("--source-fps", type=float, default=None, help="Frame rate the recording was captured at")
+    parser.add_argument("--loop", type=int, default=1, help="Number of times to play the recording")
+    parser.add_argument("--preload", action="store_true", help="Decode every frame before starting, so decoding isn't measured")
+    parser.add_argument("--capture-mode", default="full", choices=["full", "roi", "native"], help="How frames are converted before detection")
+    parser.add_argument("--prefilter", action="store_true", help="Skip matching regions that are completely flat, as PREFILTER_TEMPLATES does")
+    parser.add_argument("--cache-tolerance", type=float, default=None, help="Reuse match scores for regions where no pixel has changed by more than this")
+    parser.add_argument("--workers", type=int, default=0, help="Run independent detections on this many threads")
+    parser.add_argument("--hero", default=None, help="Lock detection to a hero instead of auto-detecting")
+    parser.add_argument("--detector-rates", type=json.loads, default=None, help='Runs per second for each detector as JSON, e.g. \'{"notifs": 30}\'')
+    parser.add_argument("--frame-budget-ms", type=float, default=None, help="Milliseconds of detection per frame before rate limited detectors are deferred")
+    parser.add_argument("--notif-rows", type=int, default=2, help="Number of kill feed rows to scan")
+    parser.add_argument("--config", default=None, help="Only run the detections this config.ini enables (default: run everything)")
+    parser.add_argument("--pipeline", action="store_true", help="Run capture and detection on their own threads, as PIPELINED_DETECTION does (use with --rate, or most frames are dropped)")
+    parser.add_argument("--timings", default=None, help="Save per-stage timings to this .json or .csv file")
+    parser.add_argument("--triggers", action="store_true", help="Apply the triggers from --config (default: config.ini) and send the vibes to a virtual device, tracing latency from capture to device command")
+    parser.add_argument("--latency-budget-ms", type=json.loads, default=None, help='p95 capture to device command latency allowed for every trigger, or for each trigger as JSON, e.g. \'{"elimination": 50}\'. Implies --triggers, and exits with an error if a budget is exceeded (use with --rate for real time latencies)')
+    return parser.parse_args()
+
+
+class ReplayActuator:
+    step_count = 20
+
+    async def command(self, value):
+        return
+
+
+class ReplayDevice:
+    # Stands in for a device, so replays can trace latency all the way to a device command
+    index = 0
+    name = "Replay device"
+
+    def __init__(self):
+        self.actuators = [ReplayActuator()]
+
+    async def stop(self):
+        return
+
+
+class ReplayOutput:
+    # Runs the triggers and vibes for each detected state, like OverStim's running loop does
+    def __init__(self, section):
+        self.triggers = Triggers(section)
+        self.device = ReplayDevice()
+        self.vibe_manager = VibeManager(get_devices=lambda: [self.device])
+        self.vibe_manager.max_intensity = section.getfloat("MAX_VIBE_INTENSITY")
+        self.vibe_manager.scale_by_max_intensity = section.getboolean("SCALE_ALL_INTENSITIES_BY_MAX_INTENSITY")
+        self.vibe_manager.device_outputs = DeviceOutputs(
+            self.vibe_manager.max_intensity,
+            rate=section.getfloat("DEVICE_OUTPUT_RATE", fallback=0),
+            device_rates=json.loads(section.get("DEVICE_OUTPUT_RATES", fallback="{}")),
+            ramp_duration=section.getfloat("DEVICE_RAMP_MS", fallback=0) / 1000,
+        )
+        self.vibe_manager.stopped = False
+        event_log.set_rate_limits(json.loads(section.get("LOG_RATE_LIMITS", fallback="{}")))
+        self.loop = asyncio.new_event_loop()
+
+    def update(self, state, current_time):
+        self.vibe_manager.set_trace_time(state.trace_time)
+        self.triggers.apply(state, self.vibe_manager)
+        self.loop.run_until_complete(self.vibe_manager.update(current_time))
+
+    def close(self):
+        self.loop.close()
+
+
+def check_latency_budgets(budgets):
+    # Returns whether every trigger's p95 latency is within its budget. Triggers that never reached the device aren't checked.
+    within_budgets = True
+    for name, histogram in sorted(timings.histograms.items()):
+        if not name.startswith("trigger latency "):
+            continue
+        trigger = name[len("trigger latency "):]
+        budget = budgets.get(trigger) if isinstance(budgets, dict) else budgets
+        if budget is None:
+            continue
+        p95 = histogram.get_summary()["p95_ms"]
+        if p95 > budget:
+            print(f"Latency budget exceeded for {trigger}: p95 {p95}ms > {budget}ms")
+            within_budgets = False
+    return within_budgets
+
+
+def run_pipelined_replay(player, source, output=None):
+    pipeline = DetectionPipeline(player, source.rate or 60, source.rate or 60)
+    events = 0
+    start_time = time.perf_counter()
+    pipeline.start()
+    try:
+        while pipeline.running or pipeline.snapshots.value is not None:
+            state = pipeline.get_snapshot(timeout=0.1)
+            if state is None:
+                continue
+            events += sum(state.new_notifs.values())
+            if state.previous_hero is not None:
+                print(f"Hero switch detected: {state.hero.name} (confidence {round(state.detected_hero_confidence, 3)})")
+            if output is not None:
+                output.update(state, state.frame_time)
+    finally:
+        duration = time.perf_counter() - start_time
+        pipeline.stop()
+        # The triggers' queued messages come before the report
+        event_log.wait_until_written()
+
+    print(f"Duration: {round(duration, 2)}s")
+    for stats in pipeline.get_stats():
+        print(stats)
+    print(f"Notifications detected: {events}")
+
+
+def run_replay(args):
+    source = ReplayFrameSource(args.source, rate=args.rate, loop=args.loop > 1, source_fps=args.source_fps, preload=args.preload)
+    detection_plan = None
+    if args.config:
+        config = configparser.ConfigParser()
+        config.read(args.config)
+        detection_plan = DetectionPlan.from_config(config["OverStim"])
+    player = OverwatchStateTracker(frame_source=source, capture_mode=args.capture_mode, prefilter=args.prefilter, cache_tolerance=args.cache_tolerance, detection_workers=args.workers, detection_plan=detection_plan, detector_rates=args.detector_rates, frame_budget=args.frame_budget_ms / 1000 if args.frame_budget_ms else None, notif_rows=args.notif_rows)
+    if detection_plan is not None:
+        print(f"Not detecting: {', '.join(detection_plan.get_skipped(player.owcv.coords)) or 'nothing'}")
+    if args.hero:
+        player.hero_auto_detect = False
+        player.switch_hero(args.hero)
+    output = None
+    if args.triggers or args.latency_budget_ms is not None:
+        config = configparser.ConfigParser()
+        config.read(args.config or "config.ini")
+        output = ReplayOutput(config["OverStim"])
+    if args.pipeline:
+        run_pipelined_replay(player, source, output)
+        report_timings(args, output)
+        return
+
+    max_frames = source.frame_count * args.loop
+    detection_times = []
+    events = 0
+    player.start_tracking(args.rate or 60)
+    start_time = time.perf_counter()
+    try:
+        while len(detection_times) < max_frames:
+            refresh_start_time = time.perf_counter()
+            player.refresh()
+            # Time spent waiting for the next frame to be due isn't detection time
+            detection_times.append(time.perf_counter() - refresh_start_time - source.last_wait_time)
+            events += sum(player.new_notifs.values())
+            if output is not None:
+                output.update(player, player.current_time)
+            if player.hero_auto_detect and player.detected_hero != player.hero.name:
+                print(f"Hero switch detected: {player.detected_hero} (confidence {round(player.detected_hero_confidence, 3)})")
+                player.switch_hero(player.detected_hero)
+    except ReplayFinished:
+        pass
+    duration = time.perf_counter() - start_time
+    player.stop_tracking()
+    event_log.wait_until_written()
+
+    if not detection_times:
+        print("No frames were processed.")
+        return
+    detection_times.sort()
+    frame_count = len(detection_times)
+    print(f"Frames: {frame_count} | Skipped: {source.frames_skipped} | Frames per second: {round(frame_count / duration, 2)}")
+    print(f"Detection latency: avg. {round(1000 * sum(detection_times) / frame_count, 2)}ms"
+          f" | p50 {round(1000 * detection_times[frame_count // 2], 2)}ms"
+          f" | p95 {round(1000 * detection_times[min(frame_count - 1, int(frame_count * 0.95))], 2)}ms"
+          f" | max {round(1000 * detection_times[-1], 2)}ms")
+    print(f"Notifications detected: {events}")
+    if player.owcv.prefilters:
+        print("Pre-filter:")
+        player.owcv.print_prefilter_stats()
+    if player.owcv.region_cache is not None:
+        print("Region cache:")
+        player.owcv.print_region_cache_stats()
+    print("Detectors:")
+    player.print_detector_stats()
+    report_timings(args, output)
+
+
+def report_timings(args, output=None):
+    print("Timings:")
+    timings.print_stats()
+    if args.timings:
+        timings.export(args.timings)
+        print(f"Timings saved to {args.timings}")
+    if output is not None:
+        output.close()
+        if args.latency_budget_ms is not None and not check_latency_budgets(args.latency_budget_ms):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    run_replay(parse_args())
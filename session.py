@@ -0,0 +1,197 @@
+import asyncio
+import json
+import time
+
+from detectionplan import DetectionPlan
+from triggers import Triggers
+from vibes import clamp_value
+from devices import DeviceOutputs
+from timing import timings
+
+
+class OverStimSession:
+    # The detection, trigger and device settings from config.ini, and the running loop that ties them together.
+    # Shared by OverStim's window and headless.py, which only differ in how they're started, stopped and show what's happening.
+    # Reading the settings raises if config.ini is broken. The player is built separately by load_player, which is slow.
+    def __init__(self, section, vibe_manager):
+        self.vibe_manager = vibe_manager
+        self.triggers = Triggers(section)
+        self.max_refresh_rate = section.getint("MAX_REFRESH_RATE")
+        self.dead_refresh_rate = section.getfloat("DEAD_REFRESH_RATE")
+        # Older config files count these in frames, which depended on MAX_REFRESH_RATE
+        self.lucio_crossfade_ms = section.getfloat("LUCIO_CROSSFADE_MS", fallback=section.getint("LUCIO_CROSSFADE_BUFFER", fallback=6) * 1000 / self.max_refresh_rate)
+        self.mercy_beam_disconnect_ms = section.getfloat("MERCY_BEAM_DISCONNECT_MS", fallback=section.getint("MERCY_BEAM_DISCONNECT_BUFFER", fallback=11) * 1000 / self.max_refresh_rate)
+        self.zen_orb_disconnect_ms = section.getfloat("ZEN_ORB_DISCONNECT_MS", fallback=section.getint("ZEN_ORB_DISCONNECT_BUFFER", fallback=27) * 1000 / self.max_refresh_rate)
+        self.capture_mode = section.get("CAPTURE_MODE", fallback="full")
+        self.prefilter_templates = section.getboolean("PREFILTER_TEMPLATES", fallback=False)
+        self.region_cache_tolerance = section.getfloat("REGION_CACHE_TOLERANCE", fallback=-1)
+        self.detection_workers = section.getint("DETECTION_WORKERS", fallback=0)
+        self.pipelined_detection = section.getboolean("PIPELINED_DETECTION", fallback=False)
+        self.detection_plan = DetectionPlan.from_config(section)
+        self.detector_rates = json.loads(section.get("DETECTOR_RATES", fallback="{}"))
+        self.detection_frame_budget_ms = section.getfloat("DETECTION_FRAME_BUDGET_MS", fallback=0)
+        self.notif_rows = section.getint("NOTIF_ROWS", fallback=2)
+        self.timings_enabled = section.getboolean("TIMINGS_ENABLED", fallback=True)
+        self.timing_export_path = section.get("TIMING_EXPORT_PATH", fallback="")
+        self.timing_export_interval = section.getfloat("TIMING_EXPORT_INTERVAL", fallback=60)
+
+        max_intensity = clamp_value(section.getfloat("MAX_VIBE_INTENSITY"), 1, value_name="MAX_VIBE_INTENSITY")
+        vibe_manager.max_intensity = max_intensity
+        vibe_manager.scale_by_max_intensity = section.getboolean("SCALE_ALL_INTENSITIES_BY_MAX_INTENSITY")
+        vibe_manager.device_outputs = DeviceOutputs(
+            max_intensity,
+            rate=section.getfloat("DEVICE_OUTPUT_RATE", fallback=0),
+            device_rates=json.loads(section.get("DEVICE_OUTPUT_RATES", fallback="{}")),
+            ramp_duration=section.getfloat("DEVICE_RAMP_MS", fallback=0) / 1000,
+        )
+        timings.enabled = self.timings_enabled
+
+        self.player = None
+        self.pipeline = None
+        self.frame_count = 0
+        self.duration = 0
+        self.cpu_time = 0
+
+    def load_player(self, frame_source=None):
+        # Can run on another thread. owstate (and with it OpenCV and dxcam) is imported here, so the window can open before it's loaded.
+        from owstate import OverwatchStateTracker
+        player = OverwatchStateTracker(
+            frame_source=frame_source,
+            capture_mode=self.capture_mode,
+            prefilter=self.prefilter_templates,
+            cache_tolerance=self.region_cache_tolerance if self.region_cache_tolerance >= 0 else None,
+            detection_workers=self.detection_workers,
+            detection_plan=self.detection_plan,
+            detector_rates=self.detector_rates,
+            frame_budget=self.detection_frame_budget_ms / 1000 if self.detection_frame_budget_ms > 0 else None,
+            notif_rows=self.notif_rows,
+        )
+        skipped_templates = self.detection_plan.get_skipped(player.owcv.coords)
+        if skipped_templates:
+            print(f"Not detecting (disabled in config): {', '.join(skipped_templates)}")
+        player.supported_heroes["Lucio"].set_crossfade_delay(self.lucio_crossfade_ms / 1000)
+        player.supported_heroes["Mercy"].set_beam_disconnect_delay(self.mercy_beam_disconnect_ms / 1000)
+        player.supported_heroes["Zenyatta"].set_orb_disconnect_delay(self.zen_orb_disconnect_ms / 1000)
+        self.player = player
+        return player
+
+    def switch_hero(self, hero_name):
+        # While pipelined, the detection thread switches hero before its next frame
+        if self.pipeline is None:
+            self.player.switch_hero(hero_name)
+        else:
+            self.pipeline.switch_hero(hero_name)
+
+    async def run(self, poll, on_hero_switch=None, max_idle_time=0.05):
+        # Runs until poll returns something other than None, which is returned. poll is called on every pass of the loop,
+        # which is at least every max_idle_time seconds, to handle the window, stop signals and lost connections.
+        # on_hero_switch(hero_name) is called when a new hero is detected.
+        # Devices are stopped and capturing ends before returning, even if the loop raises.
+        player = self.player
+        vibe_manager = self.vibe_manager
+        vibe_manager.stopped = False
+        self.pipeline = None
+        if self.pipelined_detection:
+            from pipeline import DetectionPipeline
+            self.pipeline = DetectionPipeline(player, self.max_refresh_rate, self.dead_refresh_rate)
+            self.pipeline.start()
+        else:
+            player.start_tracking(self.max_refresh_rate)
+        pipeline = self.pipeline
+        print("Running...")
+
+        frame_count = 0
+        last_refresh = 0
+        next_refresh_time = 0
+        start_time = time.time()
+        start_cpu_time = time.process_time()
+        timings.reset()
+        next_timing_export_time = start_time + self.timing_export_interval
+        result = None
+        try:
+            while True:
+                result = poll()
+                if result is not None:
+                    break
+                current_time = time.time()
+                await vibe_manager.update(current_time)
+
+                if self.timings_enabled and self.timing_export_path and current_time >= next_timing_export_time:
+                    timings.try_export(self.timing_export_path)
+                    next_timing_export_time = current_time + self.timing_export_interval
+
+                # With the pipeline, detection runs on its own thread and the triggers read snapshots of its state
+                state = None
+                if pipeline is not None:
+                    state = pipeline.get_snapshot()
+                elif current_time >= next_refresh_time:
+                    last_refresh = current_time
+                    player.refresh()
+                    frame_count += 1
+                    state = player
+
+                if state is not None:
+                    # Vibes added for this state are traced back to the capture of its frame
+                    vibe_manager.set_trace_time(state.trace_time)
+                    self.triggers.apply(state, vibe_manager)
+
+                    if pipeline is not None:
+                        # The detection thread has already switched hero
+                        if state.previous_hero is not None:
+                            print(f"Hero switch detected: {state.hero.name} (confidence {round(state.detected_hero_confidence, 3)})")
+                            if on_hero_switch is not None:
+                                on_hero_switch(state.hero.name)
+                            vibe_manager.clear_vibes_matching_regex(f"^{state.previous_hero.lower()}")
+                    elif player.hero_auto_detect and player.detected_hero != player.hero.name:
+                        print(f"Hero switch detected: {player.detected_hero} (confidence {round(player.detected_hero_confidence, 3)})")
+                        if on_hero_switch is not None:
+                            on_hero_switch(player.detected_hero)
+                        vibe_manager.clear_vibes_matching_regex(f"^{player.hero.name.lower()}")
+                        player.switch_hero(player.detected_hero)
+
+                # Sleep until the next frame, vibe change or device command is due, instead of polling as fast as possible
+                # Sleeping also gives the event loop time to respond to pings from Intiface
+                next_update_time = min(vibe_manager.get_next_update_time(), time.time() + max_idle_time)
+                if pipeline is None:
+                    next_refresh_time = last_refresh + 1 / float(self.dead_refresh_rate if player.is_dead else self.max_refresh_rate)
+                    await asyncio.sleep(max(0, min(next_refresh_time, next_update_time) - time.time()))
+                else:
+                    # Woken early when the detection thread has a new snapshot
+                    await asyncio.to_thread(pipeline.wait_for_snapshot, max(0, next_update_time - time.time()))
+        finally:
+            await vibe_manager.stop_all_devices()
+            if pipeline is None:
+                player.stop_tracking()
+            else:
+                pipeline.stop()
+                frame_count = pipeline.detection_stats.processed
+            self.frame_count = frame_count
+            self.duration = time.time() - start_time
+            self.cpu_time = time.process_time() - start_cpu_time
+        return result
+
+    def print_stats(self):
+        # What the last run achieved, printed when it stops
+        player = self.player
+        duration = max(self.duration, 1e-9)
+        print(f"Frames: {self.frame_count} | Frames per second: {round(self.frame_count / duration, 2)} | CPU time per frame: {round(1000 * self.cpu_time / max(self.frame_count, 1), 2)}ms | CPU usage: {round(100 * self.cpu_time / duration, 1)}%")
+        if player.owcv.prefilters:
+            print("Template pre-filter:")
+            player.owcv.print_prefilter_stats()
+        if player.owcv.region_cache is not None:
+            print("Region cache:")
+            player.owcv.print_region_cache_stats()
+        print("Detectors:")
+        player.print_detector_stats()
+        if self.pipeline is not None:
+            print("Pipeline:")
+            for stats in self.pipeline.get_stats():
+                print(f"  {stats}")
+        print("Device output:")
+        for stats in self.vibe_manager.device_outputs.get_stats():
+            print(f"  {stats}")
+        if self.timings_enabled:
+            print("Timings:")
+            timings.print_stats()
+            if self.timing_export_path and timings.try_export(self.timing_export_path):
+                print(f"Timings saved to {self.timing_export_path}.")
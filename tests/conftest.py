@@ -0,0 +1,18 @@
+import numpy as np
+import pytest
+
+from framesources import FrameSource
+
+
+class StillFrameSource(FrameSource):
+    # A blank 1080p screen. Tests that need a particular frame set it on ComputerVision directly.
+    def grab(self):
+        return np.zeros((1080, 1920, 3), np.uint8)
+
+    def get_latest_frame(self):
+        return self.grab()
+
+
+@pytest.fixture(scope="session")
+def frame_source():
+    return StillFrameSource()
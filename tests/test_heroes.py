@@ -0,0 +1,51 @@
+import configparser
+import random
+
+import pytest
+
+from heroes import Hysteresis
+
+
+def frame_counter_values(detections, buffer_size):
+    # How the beam, song and orb flags were smoothed before the delays were in milliseconds: off after buffer_size frames in a row without a detection
+    value = False
+    buffer = 0
+    values = []
+    for detected in detections:
+        if detected:
+            value = True
+            buffer = 0
+        elif value:
+            buffer += 1
+            if buffer >= buffer_size:
+                value = False
+        values.append(value)
+    return values
+
+
+def hysteresis_values(detections, off_delay, frame_rate, origin):
+    # Frame times are worked out like ReplayFrameSource's, from an origin and the frame index
+    hysteresis = Hysteresis(off_delay=off_delay)
+    return [hysteresis.update(detected, origin + index / frame_rate) for index, detected in enumerate(detections)]
+
+
+@pytest.mark.parametrize("setting, buffer_size", [("LUCIO_CROSSFADE_MS", 6), ("MERCY_BEAM_DISCONNECT_MS", 11), ("ZEN_ORB_DISCONNECT_MS", 27)])
+@pytest.mark.parametrize("origin", [0, 1760000000.0])
+def test_delays_match_frame_counts_at_30_fps(setting, buffer_size, origin):
+    config = configparser.ConfigParser()
+    config.read("config.ini")
+    off_delay = config["OverStim"].getfloat(setting) / 1000
+    rng = random.Random(buffer_size)
+    for gap in range(buffer_size + 3):
+        # Seen, then missing for gap frames, then seen again
+        detections = [True] * 3 + [False] * gap + [True] * 3 + [False] * (buffer_size + 3)
+        assert hysteresis_values(detections, off_delay, 30, origin) == frame_counter_values(detections, buffer_size), gap
+    for _ in range(50):
+        detections = [rng.random() < 0.3 for _ in range(300)]
+        assert hysteresis_values(detections, off_delay, 30, origin) == frame_counter_values(detections, buffer_size)
+
+
+def test_delay_between_frames_lasts_until_the_later_frame():
+    # 370ms is just over 11 frames at 30 per second, so it ends on the 12th missed frame
+    detections = [True] + [False] * 13
+    assert hysteresis_values(detections, 0.37, 30, 1760000000.0) == frame_counter_values(detections, 12)
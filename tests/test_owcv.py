@@ -0,0 +1,137 @@
+import numpy as np
+import cv2 as cv
+import pytest
+
+from framesources import FrameSource
+from owcv import TemplatePreFilter, RegionCache
+from owstate import OverwatchStateTracker, all_notif_coords, get_notif_coords
+
+
+@pytest.fixture(scope="module")
+def owcv(frame_source):
+    # No pre-filter or region cache, so every score comes from the correlation itself
+    return OverwatchStateTracker(frame_source=frame_source, capture_mode="full", prefilter=False).owcv
+
+
+def set_frame(owcv, frame):
+    owcv.frame = frame
+    owcv.frame_index += 1
+    owcv.frame_scores = {}
+
+
+def noise_frame(rng):
+    return rng.integers(0, 256, (1080, 1920), dtype=np.uint8)
+
+
+def paste(frame, template, region, rng, brightness=0):
+    top = rng.integers(region[0], region[1] - template.shape[0] + 1)
+    left = rng.integers(region[2], region[3] - template.shape[1] + 1)
+    frame[top:top + template.shape[0], left:left + template.shape[1]] = np.clip(template.astype(np.int16) + brightness, 0, 255)
+
+
+def reference_score(owcv, template_name, region):
+    cropped_frame = owcv.frame[region[0]:region[1], region[2]:region[3]]
+    if template_name in owcv.mask_names:
+        result = cv.matchTemplate(cropped_frame, owcv.templates[template_name], cv.TM_CCOEFF_NORMED, mask=owcv.masks[template_name])
+    else:
+        result = cv.matchTemplate(cropped_frame, owcv.templates[template_name], cv.TM_CCOEFF_NORMED)
+    return float(np.nanmax(result))
+
+
+def test_match_batch_matches_matchtemplate(owcv):
+    rng = np.random.default_rng(0)
+    for template_name in owcv.coords:
+        region = owcv.get_region(template_name)
+        for brightness in (0, -60, 40):
+            frame = noise_frame(rng)
+            paste(frame, owcv.templates[template_name], region, rng, brightness)
+            set_frame(owcv, frame)
+            score = owcv.match_batch([template_name])[template_name]
+            assert score == pytest.approx(reference_score(owcv, template_name, region), abs=1e-4), template_name
+
+
+def test_match_batch_scores_every_template_in_one_pass(owcv):
+    rng = np.random.default_rng(1)
+    template_names = list(owcv.coords)
+    for _ in range(3):
+        set_frame(owcv, noise_frame(rng))
+        scores = owcv.match_batch(template_names)
+        for template_name in template_names:
+            assert scores[template_name] == pytest.approx(reference_score(owcv, template_name, owcv.get_region(template_name)), abs=1e-4), template_name
+
+
+def test_scan_rows_matches_matchtemplate(owcv):
+    rng = np.random.default_rng(2)
+    row_count = 3
+    row_regions = {notif_type: [get_notif_coords(notif_type, row) for row in range(row_count)] for notif_type in all_notif_coords}
+    for notif_type in all_notif_coords:
+        frame = noise_frame(rng)
+        # A notif on the middle row, with noise above and below
+        paste(frame, owcv.templates[notif_type], row_regions[notif_type][1], rng)
+        set_frame(owcv, frame)
+        rows = owcv.scan_rows(list(all_notif_coords), row_regions)
+        assert len(rows) == row_count
+        for row, row_scores in enumerate(rows):
+            for template_name, (score, _) in row_scores.items():
+                region = owcv.get_region(template_name, row_regions[template_name][row])
+                assert score == pytest.approx(reference_score(owcv, template_name, region), abs=1e-4), (template_name, row)
+
+
+def test_prefilter_only_skips_flat_regions(owcv):
+    rng = np.random.default_rng(3)
+    for template_name in owcv.coords:
+        region = owcv.get_region(template_name)
+        template = owcv.templates[template_name]
+        # Darkened, and faded to 60% contrast, on a dark background. Both still score close to 1.
+        for adjusted_template in (np.clip(template.astype(np.int16) - 60, 0, 255), np.round(template.mean() + 0.6 * (template - template.mean()))):
+            frame = np.full((1080, 1920), 10, np.uint8)
+            paste(frame, adjusted_template.astype(np.uint8), region, rng)
+            set_frame(owcv, frame)
+            if reference_score(owcv, template_name, region) > 0.9:
+                assert TemplatePreFilter().can_match(owcv.crop(owcv.frame, template_name)), template_name
+        set_frame(owcv, np.full((1080, 1920), 40, np.uint8))
+        assert not TemplatePreFilter().can_match(owcv.crop(owcv.frame, template_name)), template_name
+        assert owcv.match_batch([template_name])[template_name] == 0.0
+
+
+def test_region_cache_notices_a_small_change():
+    region_cache = RegionCache(tolerance=8)
+    region = (0, 100, 0, 200)
+    crop = np.full((100, 200), 50, np.uint8)
+    assert region_cache.get("elimination", region, crop, 1) is None
+    region_cache.set("elimination", region, 0.2)
+    assert region_cache.get("elimination", region, crop + 8, 2) == 0.2
+    # One small icon appearing hardly moves the mean of the region, but has to clear the cached score
+    changed_crop = crop.copy()
+    changed_crop[40:60, 90:110] = 255
+    assert region_cache.get("elimination", region, changed_crop, 3) is None
+
+
+class ScreenFrameSource(FrameSource):
+    # Always shows the same screenshot, at the screenshot's resolution
+    def __init__(self, screenshot):
+        super().__init__()
+        self.screenshot = screenshot
+
+    def grab(self):
+        return self.screenshot
+
+    def get_latest_frame(self):
+        return self.screenshot
+
+
+@pytest.mark.parametrize("resolution", [(2560, 1440), (1600, 900)])
+def test_roi_scores_match_full_scores(owcv, resolution):
+    rng = np.random.default_rng(4)
+    frame = cv.GaussianBlur(noise_frame(rng), (0, 0), 1)
+    for template_name in owcv.coords:
+        paste(frame, owcv.templates[template_name], owcv.get_region(template_name), rng)
+    screenshot = cv.resize(cv.cvtColor(frame, cv.COLOR_GRAY2BGR), resolution, interpolation=cv.INTER_CUBIC)
+    scores = {}
+    for capture_mode in ("full", "roi"):
+        scaled_owcv = OverwatchStateTracker(frame_source=ScreenFrameSource(screenshot), capture_mode=capture_mode, prefilter=False).owcv
+        scaled_owcv.load_frame(screenshot, 0, 0)
+        scores[capture_mode] = scaled_owcv.match_batch(list(scaled_owcv.coords))
+    for template_name, score in scores["full"].items():
+        # Interpolation rounding can move a pixel by one gray level
+        assert scores["roi"][template_name] == pytest.approx(score, abs=2e-3), template_name
@@ -0,0 +1,24 @@
+from owstate import OverwatchStateTracker
+
+
+def test_default_rates_match_the_unscheduled_loop(frame_source):
+    # Before detectors were scheduled, the hero was checked once per second and everything else on every frame
+    player = OverwatchStateTracker(frame_source=frame_source)
+    rates = {detector.name: detector.rate for detector in player.scheduler.detectors}
+    assert rates.pop("hero") == 1
+    assert all(rate is None for rate in rates.values())
+
+
+def test_detector_rates_only_change_the_listed_detectors(frame_source):
+    player = OverwatchStateTracker(frame_source=frame_source, detector_rates={"notifs": 15, "hero": 0})
+    rates = {detector.name: detector.rate for detector in player.scheduler.detectors}
+    assert rates["notifs"] == 15
+    assert rates["hero"] is None
+    assert rates["abilities"] is None
+
+
+def test_notifs_run_before_abilities(frame_source):
+    # Mercy's resurrect check in detect_abilities reads the saves found on the same frame
+    player = OverwatchStateTracker(frame_source=frame_source)
+    names = [detector.name for detector in player.scheduler.get_due(0)]
+    assert names.index("notifs") < names.index("abilities")
@@ -0,0 +1,46 @@
+import asyncio
+import configparser
+
+from session import OverStimSession
+from vibes import VibeManager
+
+
+def load_section(**settings):
+    config = configparser.ConfigParser()
+    config.read("config.ini")
+    section = config["OverStim"]
+    for name, value in settings.items():
+        section[name] = value
+    return section
+
+
+def run_session(session, frames):
+    polls = []
+
+    def poll():
+        polls.append(None)
+        if len(polls) > frames:
+            return "Stop"
+        return None
+
+    return asyncio.run(session.run(poll, max_idle_time=0.01))
+
+
+def test_session_runs_until_poll_stops_it(frame_source):
+    vibe_manager = VibeManager()
+    session = OverStimSession(load_section(MAX_REFRESH_RATE="100"), vibe_manager)
+    session.load_player(frame_source)
+    assert run_session(session, 5) == "Stop"
+    assert session.frame_count > 0
+    assert vibe_manager.stopped
+
+
+def test_session_stats_include_every_detection_option(frame_source, capsys):
+    # OverStim and headless.py print the same stats, so none of them can go missing from one of them again
+    session = OverStimSession(load_section(MAX_REFRESH_RATE="100", PREFILTER_TEMPLATES="True", REGION_CACHE_TOLERANCE="0", TIMINGS_ENABLED="True"), VibeManager())
+    session.load_player(frame_source)
+    run_session(session, 3)
+    session.print_stats()
+    output = capsys.readouterr().out
+    for heading in ("Frames:", "Template pre-filter:", "Region cache:", "Detectors:", "Device output:", "Timings:"):
+        assert heading in output
@@ -0,0 +1,138 @@
+import configparser
+import json
+import random
+from types import SimpleNamespace
+
+import pytest
+
+from triggers import Triggers, rule_definitions
+
+
+def apply_trigger_chain(section, state, vibe_manager):
+    # The if/elif trigger chain that Triggers' rules table replaced, kept as the reference the table has to match
+    vibe_exists_for_being_hacked = vibe_manager.vibe_exists_for_trigger("hacked")
+    hacked_event = section.getint("HACKED_EVENT")
+    if hacked_event != 0:
+        if state.hacked and not vibe_exists_for_being_hacked:
+            if hacked_event == 1:
+                vibe_manager.clear_vibes()
+                vibe_manager.add_permanent_vibe(0, "hacked")
+            elif hacked_event == 2:
+                vibe_manager.clear_vibes()
+                vibe_manager.add_permanent_pattern(json.loads(section.get("HACKED_PATTERN")), "hacked")
+        elif not state.hacked and vibe_exists_for_being_hacked:
+            vibe_manager.remove_pattern_by_trigger("hacked")
+
+    if not vibe_exists_for_being_hacked:
+        if section.getboolean("VIBE_FOR_ELIM"):
+            new_elims = state.new_notifs.get("elimination", 0)
+            if new_elims > 0:
+                vibe_manager.add_timed_vibe(new_elims * section.getfloat("ELIM_VIBE_INTENSITY"), "elimination", section.getfloat("ELIM_VIBE_DURATION"))
+
+        if section.getboolean("VIBE_FOR_ASSIST"):
+            new_assists = state.new_notifs.get("assist", 0)
+            if new_assists > 0:
+                vibe_manager.add_timed_vibe(new_assists * section.getfloat("ASSIST_VIBE_INTENSITY"), "assist", section.getfloat("ASSIST_VIBE_DURATION"))
+
+        if section.getboolean("VIBE_FOR_SAVE"):
+            new_saves = state.new_notifs.get("save", 0)
+            if new_saves > 0 and (state.hero.name != "Mercy" or (state.hero.name == "Mercy" and not state.hero.resurrecting)):
+                vibe_manager.add_timed_vibe(new_saves * section.getfloat("SAVE_VIBE_INTENSITY"), "save", section.getfloat("SAVE_VIBE_DURATION"))
+
+        if section.getboolean("VIBE_FOR_BEING_BEAMED"):
+            vibe_manager.toggle_vibe_to_condition("being beamed", section.getfloat("BEING_BEAMED_VIBE_INTENSITY"), state.being_beamed)
+
+        if section.getboolean("VIBE_FOR_BEING_ORBED"):
+            vibe_manager.toggle_vibe_to_condition("being orbed", section.getfloat("BEING_ORBED_VIBE_INTENSITY"), state.being_orbed)
+
+        if state.hero.name == "Juno":
+            if section.getboolean("JUNO_VIBE_FOR_GLIDE_BOOST"):
+                vibe_manager.toggle_pattern_to_condition("juno glide boost", json.loads(section.get("JUNO_GLIDE_BOOST_PATTERN")), state.hero.glide_boost)
+            if section.getboolean("JUNO_VIBE_FOR_PULSAR_TORPEDOES"):
+                vibe_manager.toggle_pattern_to_condition("juno pulsar torpedoes", json.loads(section.get("JUNO_PULSAR_TORPEDOES_PATTERN")), state.hero.pulsar_torpedoes and not state.hero.pulsar_torpedoes_firing)
+                vibe_manager.toggle_vibe_to_condition("juno pulsar torpedoes firing", section.getfloat("JUNO_PULSAR_TORPEDOES_FIRING_INTENSITY"), state.hero.pulsar_torpedoes_firing)
+
+        elif state.hero.name == "Lucio":
+            if section.getboolean("LUCIO_VIBE_FOR_HEALING_SONG"):
+                vibe_manager.toggle_pattern_to_condition("lucio healing song", json.loads(section.get("LUCIO_HEALING_SONG_PATTERN")), state.hero.healing_song)
+            if section.getboolean("LUCIO_VIBE_FOR_SPEED_SONG"):
+                vibe_manager.toggle_pattern_to_condition("lucio speed song", json.loads(section.get("LUCIO_SPEED_SONG_PATTERN")), state.hero.speed_song)
+
+        elif state.hero.name == "Mercy":
+            if section.getboolean("MERCY_VIBE_FOR_RESURRECT"):
+                if state.hero.resurrecting and not vibe_manager.vibe_for_trigger_created_within_seconds("mercy resurrect", 3):
+                    vibe_manager.add_timed_vibe(section.getfloat("MERCY_RESURRECT_VIBE_INTENSITY"), "mercy resurrect", section.getfloat("MERCY_RESURRECT_VIBE_DURATION"))
+            if section.getboolean("MERCY_VIBE_FOR_HEAL_BEAM"):
+                vibe_manager.toggle_vibe_to_condition("mercy heal beam", section.getfloat("MERCY_HEAL_BEAM_VIBE_INTENSITY"), state.hero.heal_beam)
+            if section.getboolean("MERCY_VIBE_FOR_DAMAGE_BEAM"):
+                vibe_manager.toggle_vibe_to_condition("mercy damage beam", section.getfloat("MERCY_DAMAGE_BEAM_VIBE_INTENSITY"), state.hero.damage_beam)
+
+        elif state.hero.name == "Zenyatta":
+            if section.getboolean("ZEN_VIBE_FOR_HARMONY_ORB"):
+                vibe_manager.toggle_vibe_to_condition("zenyatta harmony orb", section.getfloat("ZEN_HARMONY_ORB_VIBE_INTENSITY"), state.hero.harmony_orb)
+            if section.getboolean("ZEN_VIBE_FOR_DISCORD_ORB"):
+                vibe_manager.toggle_vibe_to_condition("zenyatta discord orb", section.getfloat("ZEN_DISCORD_ORB_VIBE_INTENSITY"), state.hero.discord_orb)
+
+
+class RecordingVibeManager:
+    # Records every call the triggers make. The queries are answered from the same random draws for both implementations.
+    def __init__(self, existing_triggers, recent_triggers):
+        self.existing_triggers = existing_triggers
+        self.recent_triggers = recent_triggers
+        self.calls = []
+
+    def vibe_exists_for_trigger(self, trigger):
+        return trigger in self.existing_triggers
+
+    def vibe_for_trigger_created_within_seconds(self, trigger, seconds):
+        return trigger in self.recent_triggers
+
+    def __getattr__(self, name):
+        return lambda *args: self.calls.append((name, args))
+
+
+def random_state(rng):
+    hero_name = rng.choice(["Other", "Baptiste", "Juno", "Lucio", "Mercy", "Zenyatta"])
+    hero = SimpleNamespace(
+        name=hero_name,
+        glide_boost=rng.random() < 0.5,
+        pulsar_torpedoes=rng.random() < 0.5,
+        pulsar_torpedoes_firing=rng.random() < 0.5,
+        healing_song=rng.random() < 0.5,
+        speed_song=rng.random() < 0.5,
+        resurrecting=rng.random() < 0.5,
+        heal_beam=rng.random() < 0.5,
+        damage_beam=rng.random() < 0.5,
+        harmony_orb=rng.random() < 0.5,
+        discord_orb=rng.random() < 0.5,
+    )
+    new_notifs = {notif_type: rng.choice([0, 0, 1, 2]) for notif_type in ("elimination", "assist", "save") if rng.random() < 0.7}
+    return SimpleNamespace(hero=hero, hacked=rng.random() < 0.2, being_beamed=rng.random() < 0.5, being_orbed=rng.random() < 0.5, new_notifs=new_notifs)
+
+
+def random_section(rng):
+    config = configparser.ConfigParser()
+    config.read("config.ini")
+    section = config["OverStim"]
+    for _, setting, _ in rule_definitions:
+        section[setting] = str(rng.random() < 0.7)
+    section["HACKED_EVENT"] = str(rng.choice([0, 1, 2]))
+    return section
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_rules_table_matches_trigger_chain(seed):
+    rng = random.Random(seed)
+    section = random_section(rng)
+    triggers = Triggers(section)
+    trigger_names = ["hacked", "mercy resurrect", "elimination", "being beamed", "lucio healing song"]
+    # The hero changes between frames, so the table is recompiled as it would be in a match
+    for _ in range(250):
+        state = random_state(rng)
+        existing_triggers = {trigger for trigger in trigger_names if rng.random() < 0.3}
+        recent_triggers = {trigger for trigger in trigger_names if rng.random() < 0.5}
+        expected = RecordingVibeManager(existing_triggers, recent_triggers)
+        actual = RecordingVibeManager(existing_triggers, recent_triggers)
+        apply_trigger_chain(section, state, expected)
+        triggers.apply(state, actual)
+        assert actual.calls == expected.calls
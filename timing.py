@@ -0,0 +1,181 @@
+from collections import deque
+import json
+import csv
+import os
+import time
+
+from eventlog import event_log
+
+
+def get_percentile(sorted_samples, percentile):
+    return sorted_samples[min(len(sorted_samples) - 1, int(len(sorted_samples) * percentile))]
+
+
+class LatencyHistogram:
+    # The most recent samples of one stage's duration (in seconds), so percentiles follow what's happening now rather than since startup
+    def __init__(self, name, window=1000):
+        self.name = name
+        self.samples = deque(maxlen=window)
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def add(self, duration):
+        self.samples.append(duration)
+        self.count += 1
+        self.total += duration
+        self.max = max(self.max, duration)
+
+    def get_summary(self):
+        # Copied first, as other threads can add samples while it's sorted
+        samples = sorted(list(self.samples))
+        if not samples:
+            return {"count": self.count, "mean_ms": 0, "p50_ms": 0, "p95_ms": 0, "p99_ms": 0, "max_ms": 0}
+        return {
+            "count": self.count,
+            "mean_ms": round(1000 * self.total / self.count, 3),
+            "p50_ms": round(1000 * get_percentile(samples, 0.5), 3),
+            "p95_ms": round(1000 * get_percentile(samples, 0.95), 3),
+            "p99_ms": round(1000 * get_percentile(samples, 0.99), 3),
+            "max_ms": round(1000 * self.max, 3),
+        }
+
+    def __str__(self):
+        summary = self.get_summary()
+        return f"{self.name}: {summary['count']} samples | avg. {summary['mean_ms']}ms | p50 {summary['p50_ms']}ms | p95 {summary['p95_ms']}ms | p99 {summary['p99_ms']}ms | max {summary['max_ms']}ms"
+
+
+class StageTimer:
+    def __init__(self, histogram):
+        self.histogram = histogram
+        self.start_time = 0
+
+    def __enter__(self):
+        self.start_time = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.add(time.perf_counter() - self.start_time)
+
+
+class NullTimer:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return None
+
+
+null_timer = NullTimer()
+
+
+class Timings:
+    # Rolling latency histograms for each named stage, e.g. "capture", "match elimination" or "device output".
+    # Stages are timed with `with timings.time(name):`, or timings.add_since(name, start_time) inside loops.
+    def __init__(self, enabled=True, window=1000):
+        self.enabled = enabled
+        self.window = window
+        self.histograms = {}
+
+    def get_histogram(self, name):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            # setdefault, so two threads timing a new stage at once share one histogram
+            histogram = self.histograms.setdefault(name, LatencyHistogram(name, self.window))
+        return histogram
+
+    def time(self, name):
+        if not self.enabled:
+            return null_timer
+        return StageTimer(self.get_histogram(name))
+
+    def add(self, name, duration):
+        if self.enabled:
+            self.get_histogram(name).add(duration)
+
+    def add_since(self, name, start_time):
+        # start_time from time.perf_counter()
+        if self.enabled:
+            self.get_histogram(name).add(time.perf_counter() - start_time)
+
+    def reset(self):
+        self.histograms = {}
+
+    def get_snapshot(self):
+        return {name: histogram.get_summary() for name, histogram in sorted(list(self.histograms.items()))}
+
+    def print_stats(self):
+        for name, histogram in sorted(list(self.histograms.items())):
+            print(f"  {histogram}")
+
+    def try_export(self, path):
+        # For exports while running, where a full disk or a file that's open elsewhere shouldn't end the session
+        try:
+            self.export(path)
+            return True
+        except OSError as export_error:
+            event_log.log(f"Could not save timings to {path}: {export_error}")
+            return False
+
+    def export(self, path):
+        # .json files are overwritten with the latest snapshot, .csv files get a row per stage appended for every export
+        snapshot = self.get_snapshot()
+        export_time = time.time()
+        if path.lower().endswith(".csv"):
+            columns = ["time", "stage", "count", "mean_ms", "p50_ms", "p95_ms", "p99_ms", "max_ms"]
+            write_header = not os.path.exists(path) or os.path.getsize(path) == 0
+            with open(path, "a", newline="") as export_file:
+                writer = csv.writer(export_file)
+                if write_header:
+                    writer.writerow(columns)
+                for name, summary in snapshot.items():
+                    writer.writerow([round(export_time, 3), name] + [summary[column] for column in columns[2:]])
+        else:
+            with open(path, "w") as export_file:
+                json.dump({"time": export_time, "stages": snapshot}, export_file, indent=4)
+
+
+class StartupTimer:
+    # Times each phase of startup once, to see what keeps the window from being ready.
+    # Phases on the main thread are marked in order, and ones running in the background are timed with `with startup_timer.time(name):`.
+    def __init__(self):
+        self.start_time = time.perf_counter()
+        self.last_mark_time = self.start_time
+        self.phases = []
+
+    def mark(self, name):
+        # The time since the previous mark
+        current_time = time.perf_counter()
+        self.phases.append((name, current_time - self.last_mark_time, False))
+        self.last_mark_time = current_time
+
+    def time(self, name):
+        return BackgroundPhaseTimer(self, name)
+
+    def get_elapsed_time(self):
+        return time.perf_counter() - self.start_time
+
+    def print_stats(self):
+        for name, duration, background in list(self.phases):
+            print(f"  {name}: {round(1000 * duration, 1)}ms" + (" (background)" if background else ""))
+        print(f"  Total: {round(1000 * self.get_elapsed_time(), 1)}ms")
+
+
+class BackgroundPhaseTimer:
+    def __init__(self, startup_timer, name):
+        self.startup_timer = startup_timer
+        self.name = name
+        self.start_time = 0
+
+    def __enter__(self):
+        self.start_time = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.startup_timer.phases.append((self.name, time.perf_counter() - self.start_time, True))
+
+
+# Shared by every module, so stages can be timed without passing a timer through each constructor
+timings = Timings()
+# Starts when timing is first imported, which OverStim does before anything else
+startup_timer = StartupTimer()
@@ -0,0 +1,123 @@
+from operator import attrgetter
+import json
+
+
+class NotifVibe:
+    # A timed vibe for each new kill feed notification, e.g. eliminations
+    def __init__(self, trigger, notif, intensity, duration, condition=None):
+        self.trigger = trigger
+        self.notif = notif
+        self.intensity = intensity
+        self.duration = duration
+        self.condition = condition
+
+    def apply(self, state, vibe_manager):
+        new_notifs = state.new_notifs.get(self.notif, 0)
+        if new_notifs > 0 and (self.condition is None or self.condition(state)):
+            vibe_manager.add_timed_vibe(new_notifs * self.intensity, self.trigger, self.duration)
+
+
+class ConditionVibe:
+    # A vibe that lasts for as long as the condition is true, e.g. while Mercy's heal beam is connected
+    def __init__(self, trigger, intensity, condition):
+        self.trigger = trigger
+        self.intensity = intensity
+        self.condition = condition
+
+    def apply(self, state, vibe_manager):
+        vibe_manager.toggle_vibe_to_condition(self.trigger, self.intensity, self.condition(state))
+
+
+class ConditionPattern:
+    # A pattern that loops for as long as the condition is true
+    def __init__(self, trigger, pattern, condition):
+        self.trigger = trigger
+        self.pattern = pattern
+        self.condition = condition
+
+    def apply(self, state, vibe_manager):
+        vibe_manager.toggle_pattern_to_condition(self.trigger, self.pattern, self.condition(state))
+
+
+class OnsetVibe:
+    # A timed vibe when the condition becomes true, at most once every cooldown seconds
+    def __init__(self, trigger, intensity, duration, condition, cooldown):
+        self.trigger = trigger
+        self.intensity = intensity
+        self.duration = duration
+        self.condition = condition
+        self.cooldown = cooldown
+
+    def apply(self, state, vibe_manager):
+        if self.condition(state) and not vibe_manager.vibe_for_trigger_created_within_seconds(self.trigger, self.cooldown):
+            vibe_manager.add_timed_vibe(self.intensity, self.trigger, self.duration)
+
+
+# Every trigger as (hero, or None for all heroes, the setting that enables it, a function that builds its rule from the config section).
+# Conditions read attributes of the detected state, so a new trigger is a row here and a setting in config.ini.
+rule_definitions = [
+    # All-hero triggers
+    (None, "VIBE_FOR_ELIM", lambda section: NotifVibe("elimination", "elimination", section.getfloat("ELIM_VIBE_INTENSITY"), section.getfloat("ELIM_VIBE_DURATION"))),
+    (None, "VIBE_FOR_ASSIST", lambda section: NotifVibe("assist", "assist", section.getfloat("ASSIST_VIBE_INTENSITY"), section.getfloat("ASSIST_VIBE_DURATION"))),
+    # Mercy's resurrect also shows a save, which has its own trigger
+    (None, "VIBE_FOR_SAVE", lambda section: NotifVibe("save", "save", section.getfloat("SAVE_VIBE_INTENSITY"), section.getfloat("SAVE_VIBE_DURATION"), lambda state: state.hero.name != "Mercy" or not state.hero.resurrecting)),
+    (None, "VIBE_FOR_BEING_BEAMED", lambda section: ConditionVibe("being beamed", section.getfloat("BEING_BEAMED_VIBE_INTENSITY"), attrgetter("being_beamed"))),
+    (None, "VIBE_FOR_BEING_ORBED", lambda section: ConditionVibe("being orbed", section.getfloat("BEING_ORBED_VIBE_INTENSITY"), attrgetter("being_orbed"))),
+
+    # Juno
+    ("Juno", "JUNO_VIBE_FOR_GLIDE_BOOST", lambda section: ConditionPattern("juno glide boost", json.loads(section.get("JUNO_GLIDE_BOOST_PATTERN")), attrgetter("hero.glide_boost"))),
+    ("Juno", "JUNO_VIBE_FOR_PULSAR_TORPEDOES", lambda section: ConditionPattern("juno pulsar torpedoes", json.loads(section.get("JUNO_PULSAR_TORPEDOES_PATTERN")), lambda state: state.hero.pulsar_torpedoes and not state.hero.pulsar_torpedoes_firing)),
+    ("Juno", "JUNO_VIBE_FOR_PULSAR_TORPEDOES", lambda section: ConditionVibe("juno pulsar torpedoes firing", section.getfloat("JUNO_PULSAR_TORPEDOES_FIRING_INTENSITY"), attrgetter("hero.pulsar_torpedoes_firing"))),
+
+    # Lucio
+    ("Lucio", "LUCIO_VIBE_FOR_HEALING_SONG", lambda section: ConditionPattern("lucio healing song", json.loads(section.get("LUCIO_HEALING_SONG_PATTERN")), attrgetter("hero.healing_song"))),
+    ("Lucio", "LUCIO_VIBE_FOR_SPEED_SONG", lambda section: ConditionPattern("lucio speed song", json.loads(section.get("LUCIO_SPEED_SONG_PATTERN")), attrgetter("hero.speed_song"))),
+
+    # Mercy
+    ("Mercy", "MERCY_VIBE_FOR_RESURRECT", lambda section: OnsetVibe("mercy resurrect", section.getfloat("MERCY_RESURRECT_VIBE_INTENSITY"), section.getfloat("MERCY_RESURRECT_VIBE_DURATION"), attrgetter("hero.resurrecting"), 3)),
+    ("Mercy", "MERCY_VIBE_FOR_HEAL_BEAM", lambda section: ConditionVibe("mercy heal beam", section.getfloat("MERCY_HEAL_BEAM_VIBE_INTENSITY"), attrgetter("hero.heal_beam"))),
+    ("Mercy", "MERCY_VIBE_FOR_DAMAGE_BEAM", lambda section: ConditionVibe("mercy damage beam", section.getfloat("MERCY_DAMAGE_BEAM_VIBE_INTENSITY"), attrgetter("hero.damage_beam"))),
+
+    # Zenyatta
+    ("Zenyatta", "ZEN_VIBE_FOR_HARMONY_ORB", lambda section: ConditionVibe("zenyatta harmony orb", section.getfloat("ZEN_HARMONY_ORB_VIBE_INTENSITY"), attrgetter("hero.harmony_orb"))),
+    ("Zenyatta", "ZEN_VIBE_FOR_DISCORD_ORB", lambda section: ConditionVibe("zenyatta discord orb", section.getfloat("ZEN_DISCORD_ORB_VIBE_INTENSITY"), attrgetter("hero.discord_orb"))),
+]
+
+
+class Triggers:
+    # Turns the detected state (an OverwatchStateTracker or a StateSnapshot) into vibes, using the trigger settings from config.ini.
+    # Rules for disabled triggers are never built, and each frame only runs the all-hero rules and the current hero's.
+    def __init__(self, section):
+        self.hacked_event = section.getint("HACKED_EVENT")
+        self.hacked_pattern = json.loads(section.get("HACKED_PATTERN"))
+        # Enabled rules by hero, with None for the all-hero rules
+        self.rule_table = {}
+        for hero_name, setting, build_rule in rule_definitions:
+            if section.getboolean(setting):
+                self.rule_table.setdefault(hero_name, []).append(build_rule(section))
+        self.hero_name = None
+        self.rules = []
+
+    def compile_rules(self, hero_name):
+        # Called whenever the hero changes
+        self.hero_name = hero_name
+        self.rules = self.rule_table.get(None, []) + self.rule_table.get(hero_name, [])
+
+    def apply(self, state, vibe_manager):
+        vibe_exists_for_being_hacked = vibe_manager.vibe_exists_for_trigger("hacked")
+        if self.hacked_event != 0:
+            if state.hacked and not vibe_exists_for_being_hacked:
+                if self.hacked_event == 1:
+                    vibe_manager.clear_vibes()
+                    vibe_manager.add_permanent_vibe(0, "hacked")
+                elif self.hacked_event == 2:
+                    vibe_manager.clear_vibes()
+                    vibe_manager.add_permanent_pattern(self.hacked_pattern, "hacked")
+            elif not state.hacked and vibe_exists_for_being_hacked:
+                vibe_manager.remove_pattern_by_trigger("hacked")
+
+        if not vibe_exists_for_being_hacked:
+            if state.hero.name != self.hero_name:
+                self.compile_rules(state.hero.name)
+            for rule in self.rules:
+                rule.apply(state, vibe_manager)
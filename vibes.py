@@ -0,0 +1,386 @@
+import heapq
+import time
+import re
+from bisect import bisect_right
+from itertools import accumulate, count
+
+import numpy as np
+
+from devices import DeviceOutputs
+from timing import timings
+from eventlog import event_log
+
+
+def clamp_value(value, max_value, min_value=0, value_name="value"):
+    if value > max_value:
+        value = max_value
+    elif value < min_value:
+        print(f"Tried to set {value_name} to {value} but it cannot be lower than {min_value}. Setting it to {min_value}.")
+        value = min_value
+    return value
+
+
+class CompiledPattern:
+    # A [[intensity, duration], ...] pattern compiled into the time each step ends, measured from the start of a loop.
+    # Finding the intensity at any point is a bisect, and looping is a modulo, so nothing is rebuilt while a vibe is active.
+    def __init__(self, pattern):
+        self.intensities = [pair[0] for pair in pattern]
+        self.end_times = list(accumulate(pair[1] for pair in pattern))
+        self.duration = self.end_times[-1]
+        # A pattern with one intensity never changes, so its vibes can be summed ahead of time
+        self.constant = len(set(self.intensities)) == 1
+        self.intensity_array = np.array(self.intensities, np.float64)
+        self.end_time_array = np.array(self.end_times, np.float64)
+
+    def get_intensity(self, elapsed_time):
+        if self.constant:
+            return self.intensities[0]
+        return self.intensities[bisect_right(self.end_times, elapsed_time % self.duration)]
+
+    def get_total_intensity(self, elapsed_times):
+        # The summed intensity of several vibes playing this pattern, elapsed_times being how long each has been playing
+        return float(self.intensity_array[np.searchsorted(self.end_time_array, np.mod(elapsed_times, self.duration), side="right")].sum())
+
+    def get_time_until_change(self, elapsed_time):
+        # How long until a vibe that has been playing this pattern for elapsed_time moves on to its next step
+        loop_time = elapsed_time % self.duration
+        return self.end_times[bisect_right(self.end_times, loop_time)] - loop_time
+
+    def get_min_time_until_change(self, elapsed_times):
+        loop_times = np.mod(elapsed_times, self.duration)
+        return float((self.end_time_array[np.searchsorted(self.end_time_array, loop_times, side="right")] - loop_times).min())
+
+
+compiled_patterns = {}
+
+def compile_pattern(pattern):
+    # Vibes added with the same pattern (e.g. every elimination) share one compiled copy
+    key = tuple(tuple(pair) for pair in pattern)
+    compiled_pattern = compiled_patterns.get(key)
+    if compiled_pattern is None:
+        compiled_pattern = compiled_patterns[key] = CompiledPattern(pattern)
+    return compiled_pattern
+
+
+class Vibe:
+    def __init__(self, pattern, trigger, current_time, loop_count=None, total_duration=None):
+        self.pattern = compile_pattern(pattern)
+        self.trigger = trigger
+        self.creation_time = current_time
+        self.removed = False
+        # Wall clock times of the frame that caused the vibe and of its creation, used to trace latency to the devices
+        self.source_time = None
+        self.created_at = None
+
+        if total_duration:
+            self.expiry = current_time + total_duration
+        elif loop_count:
+            self.expiry = current_time + self.pattern.duration * loop_count
+        else:
+            self.expiry = float("inf")
+
+    def get_intensity(self, current_time):
+        if current_time >= self.expiry:
+            return -1
+        return self.pattern.get_intensity(current_time - self.creation_time)
+
+
+class PermanentVibe(Vibe):
+    def __init__(self, pattern, trigger, current_time):
+        super().__init__(pattern=pattern, trigger=trigger, current_time=current_time)
+
+
+class TimedVibe(Vibe):
+    def __init__(self, pattern, trigger, total_duration, current_time):
+        super().__init__(pattern=pattern, trigger=trigger, current_time=current_time, total_duration=total_duration)
+
+
+class LoopedVibe(Vibe):
+    def __init__(self, pattern, trigger, loop_count, current_time):
+        super().__init__(pattern=pattern, trigger=trigger, current_time=current_time, loop_count=loop_count)
+
+
+class ActiveVibes:
+    # The vibes that are playing, by trigger. Expiry times are kept in a heap, so expired vibes are found without checking every vibe,
+    # and the intensities of constant vibes are kept as a running total, so only patterned vibes are evaluated on each update.
+    # Patterned vibes are grouped by pattern, and a group that's large enough is looked up with one vectorised search.
+    vectorise_group_size = 8
+
+    def __init__(self):
+        self.by_trigger = {}
+        self.expiry_heap = []
+        self.expiry_order = count() # Breaks ties between vibes that expire at the same time
+        self.constant_intensity = 0
+        self.constant_vibe_count = 0
+        self.patterned_vibes = {} # Compiled pattern: vibes playing it
+        self.creation_times = {} # Compiled pattern: array of its vibes' creation times, rebuilt when the vibes change
+
+    def add(self, vibe):
+        self.by_trigger.setdefault(vibe.trigger, []).append(vibe)
+        if vibe.expiry != float("inf"):
+            heapq.heappush(self.expiry_heap, (vibe.expiry, next(self.expiry_order), vibe))
+        if vibe.pattern.constant:
+            self.constant_intensity += vibe.pattern.intensities[0]
+            self.constant_vibe_count += 1
+        else:
+            self.patterned_vibes.setdefault(vibe.pattern, []).append(vibe)
+            self.creation_times.pop(vibe.pattern, None)
+
+    def remove(self, vibe):
+        self.by_trigger[vibe.trigger].remove(vibe)
+        if not self.by_trigger[vibe.trigger]:
+            del self.by_trigger[vibe.trigger]
+        self._forget(vibe)
+
+    def remove_trigger(self, trigger):
+        for vibe in self.by_trigger.pop(trigger):
+            self._forget(vibe)
+
+    def clear(self):
+        self.by_trigger.clear()
+        self.expiry_heap.clear()
+        self.constant_intensity = 0
+        self.constant_vibe_count = 0
+        self.patterned_vibes.clear()
+        self.creation_times.clear()
+
+    def _forget(self, vibe):
+        # Removed vibes stay in the expiry heap until they would have expired, and are skipped then
+        vibe.removed = True
+        if vibe.pattern.constant:
+            self.constant_vibe_count -= 1
+            # Don't let floating point error build up in the running total
+            self.constant_intensity = self.constant_intensity - vibe.pattern.intensities[0] if self.constant_vibe_count else 0
+        else:
+            self.patterned_vibes[vibe.pattern].remove(vibe)
+            if not self.patterned_vibes[vibe.pattern]:
+                del self.patterned_vibes[vibe.pattern]
+            self.creation_times.pop(vibe.pattern, None)
+
+    def expire(self, current_time):
+        while self.expiry_heap and self.expiry_heap[0][0] <= current_time:
+            vibe = heapq.heappop(self.expiry_heap)[2]
+            if not vibe.removed:
+                self.remove(vibe)
+
+    def get_vibes(self, triggers=None):
+        if triggers is None:
+            triggers = self.by_trigger.keys()
+        list_of_vibes = []
+        for trigger in triggers:
+            list_of_vibes.extend(self.by_trigger.get(trigger, []))
+        return list_of_vibes
+
+    def get_total_intensity(self, current_time):
+        self.expire(current_time)
+        total_intensity = self.constant_intensity
+        for pattern, vibes in self.patterned_vibes.items():
+            if len(vibes) < self.vectorise_group_size:
+                total_intensity += sum(pattern.get_intensity(current_time - vibe.creation_time) for vibe in vibes)
+                continue
+            total_intensity += pattern.get_total_intensity(current_time - self._get_creation_times(pattern, vibes))
+        return total_intensity
+
+    def get_next_change_time(self, current_time):
+        # The soonest a vibe expires or a patterned vibe moves on to its next step, so the main loop can sleep until then
+        self.expire(current_time)
+        next_change_time = self.expiry_heap[0][0] if self.expiry_heap else float("inf")
+        for pattern, vibes in self.patterned_vibes.items():
+            if len(vibes) < self.vectorise_group_size:
+                time_until_change = min(pattern.get_time_until_change(current_time - vibe.creation_time) for vibe in vibes)
+            else:
+                time_until_change = pattern.get_min_time_until_change(current_time - self._get_creation_times(pattern, vibes))
+            next_change_time = min(next_change_time, current_time + time_until_change)
+        return next_change_time
+
+    def _get_creation_times(self, pattern, vibes):
+        creation_times = self.creation_times.get(pattern)
+        if creation_times is None:
+            creation_times = self.creation_times[pattern] = np.array([vibe.creation_time for vibe in vibes], np.float64)
+        return creation_times
+
+
+class VibeManager:
+    # get_devices returns the devices to send intensities to. on_intensity_change(current_intensity, real_intensity) and on_stop
+    # let the GUI show the intensity without VibeManager depending on it.
+    def __init__(self, get_devices=None, on_intensity_change=None, on_stop=None):
+        self.stopped = True
+        self.current_time = 0
+        self.active_vibes = ActiveVibes()
+        self.vibes = self.active_vibes.by_trigger
+        self.current_intensity = 0
+        self.real_intensity = 0
+        self.max_intensity = 1
+        self.scale_by_max_intensity = True
+        self.device_outputs = DeviceOutputs()
+        self.get_devices = get_devices if get_devices is not None else list
+        self.on_intensity_change = on_intensity_change
+        self.on_stop = on_stop
+        # Capture time of the frame the triggers are being applied for, stamped onto the vibes they add
+        self.trace_time = None
+        # (trigger, capture time, vibe creation time) of vibes added since the last update
+        self.new_traces = []
+
+    def set_trace_time(self, capture_time):
+        self.trace_time = capture_time
+
+    def _add_vibe(self, vibe):
+        if not self.stopped:
+            vibe.created_at = time.time()
+            vibe.source_time = vibe.created_at if self.trace_time is None else self.trace_time
+            self.active_vibes.add(vibe)
+            self.new_traces.append((vibe.trigger, vibe.source_time, vibe.created_at))
+
+    def add_permanent_vibe(self, amount, trigger):
+        # The 60 here is arbitrary, as the pattern only has one intensity
+        self._add_vibe(PermanentVibe([[amount, 60]], trigger, self.current_time))
+
+    def add_timed_vibe(self, amount, trigger, duration):
+        self._add_vibe(TimedVibe([[amount, duration]], trigger, duration, self.current_time))
+
+    def add_permanent_pattern(self, pattern, trigger):
+        self._add_vibe(PermanentVibe(pattern, trigger, self.current_time))
+
+    def add_timed_pattern(self, pattern, trigger, duration):
+        self._add_vibe(TimedVibe(pattern, trigger, duration, self.current_time))
+
+    def add_looped_pattern(self, pattern, trigger, loop_count):
+        self._add_vibe(LoopedVibe(pattern, trigger, loop_count, self.current_time))
+
+    def _remove_vibe(self, vibe):
+        self.active_vibes.remove(vibe)
+
+    def remove_vibe_by_trigger(self, trigger, index=0):
+        # Index of 0 removes the oldest vibe, index of -1 removes the newest vibe.
+        if self.vibe_exists_for_trigger(trigger):
+            vibe = self._get_vibes([trigger])[index]
+            self._remove_vibe(vibe)
+
+    def remove_pattern_by_trigger(self, trigger, index=0):
+        self.remove_vibe_by_trigger(trigger=trigger, index=index)
+
+    def toggle_vibe_to_condition(self, trigger, intensity, condition):
+        vibe_exists_for_trigger = self.vibe_exists_for_trigger(trigger)
+        if condition and not vibe_exists_for_trigger:
+            self.add_permanent_vibe(intensity, trigger)
+        elif not condition and vibe_exists_for_trigger:
+            self.remove_vibe_by_trigger(trigger)
+
+    def toggle_pattern_to_condition(self, trigger, pattern, condition):
+        vibe_exists_for_trigger = self.vibe_exists_for_trigger(trigger)
+        if condition and not vibe_exists_for_trigger:
+            self.add_permanent_pattern(pattern, trigger)
+        elif not condition and vibe_exists_for_trigger:
+            self.remove_vibe_by_trigger(trigger)
+
+    def clear_vibes(self, triggers=None):
+        if triggers is None:
+            self.active_vibes.clear()
+        else:
+            for trigger in triggers:
+                self.active_vibes.remove_trigger(trigger)
+    
+    def clear_vibes_matching_regex(self, regex_pattern):
+        regex = re.compile(regex_pattern)
+        triggers = [trigger for trigger in self.vibes.keys() if regex.match(trigger)]
+        self.clear_vibes(triggers)
+
+    async def stop_all_devices(self):
+        self.stopped = True
+        self.clear_vibes()
+        await self.device_outputs.stop(self.get_devices())
+        self.current_intensity = 0
+        self.real_intensity = 0
+        self.new_traces = []
+        event_log.log("Stopped all devices.")
+        if self.on_stop is not None:
+            self.on_stop()
+
+    def _get_vibes(self, triggers=None):
+        return self.active_vibes.get_vibes(triggers)
+
+    def vibe_exists_for_trigger(self, trigger):
+        if self._get_vibes([trigger]):
+            return True
+        return False
+
+    def pattern_exists_for_trigger(self, trigger):
+        return self.vibe_exists_for_trigger(trigger)
+
+    def vibe_for_trigger_created_within_seconds(self, trigger, seconds):
+        return len([vibe.creation_time > self.current_time - seconds for vibe in self._get_vibes([trigger])]) > 0
+
+    def pattern_for_trigger_created_within_seconds(self, trigger, seconds):
+        return self.vibe_for_trigger_created_within_seconds(trigger, seconds)
+
+    def count_vibes_for_trigger(self, trigger):
+        return len(self._get_vibes([trigger]))
+
+    def count_patterns_for_trigger(self, trigger):
+        return self.count_vibes_for_trigger(trigger)
+
+    def _get_total_intensity(self, triggers=None):
+        if triggers is None:
+            return self.active_vibes.get_total_intensity(self.current_time)
+        total_intensity = 0
+        for vibe in self._get_vibes(triggers):
+            intensity = vibe.get_intensity(self.current_time)
+            if intensity == -1:
+                self._remove_vibe(vibe)
+            else:
+                total_intensity += intensity
+        return total_intensity
+
+    async def _update_intensity_for_devices(self, devices):
+        # Every device that's due a tick is updated at once, and only actuators whose intensity step changed are sent a command
+        await self.device_outputs.update(devices, self.current_time)
+
+    def get_next_update_time(self):
+        # The soonest the total intensity can change or a device is due a command, without any new detections
+        next_update_time = self.active_vibes.get_next_change_time(self.current_time)
+        next_tick_time = self.device_outputs.get_next_tick_time()
+        if next_tick_time is not None:
+            next_update_time = min(next_update_time, next_tick_time)
+        return next_update_time
+
+    def get_active_triggers(self):
+        active_triggers = []
+        for trigger, vibes in self.vibes.items():
+            trigger_quantity = len(vibes)
+            # Trigger quantity should never be less than 1, because any time the last vibe for a trigger is removed, that trigger is also removed.
+            active_triggers.append(trigger if trigger_quantity == 1 else f"{trigger} (x{trigger_quantity})")
+        return active_triggers
+
+    async def update(self, current_time):
+        if self.stopped:
+            if self.current_intensity != 0:
+                await self.stop_all_devices()
+            return
+        update_start_time = time.perf_counter()
+        self.current_time = current_time
+        # Vibes that don't change the intensity never reach a device, so their traces are dropped
+        new_traces = self.new_traces
+        self.new_traces = []
+        latest_intensity = self._get_total_intensity()
+        if self.scale_by_max_intensity:
+            latest_intensity *= self.max_intensity
+        latest_intensity = abs(round(latest_intensity, 4))
+        if self.current_intensity != latest_intensity:
+            self.current_intensity = latest_intensity
+            latest_clamped_intensity = clamp_value(self.current_intensity, self.max_intensity, value_name="intensity")
+            intensity_message = f"Updated intensity: {self.current_intensity}" + ("" if self.current_intensity == latest_clamped_intensity else f" ({latest_clamped_intensity})")
+            if self.real_intensity != latest_clamped_intensity:
+                self.real_intensity = latest_clamped_intensity
+                active_triggers = self.get_active_triggers()
+                if active_triggers:
+                    # TODO: Break into two indented lines if line length > width of debug window
+                    intensity_message += f"\n  {', '.join(active_triggers)}"
+                self.device_outputs.set_intensity(self.real_intensity, new_traces)
+
+                if self.on_intensity_change is not None:
+                    self.on_intensity_change(self.current_intensity, self.real_intensity)
+            # Queued rather than printed, so a busy console or output window can't hold up the update
+            event_log.log(intensity_message, kind="intensity")
+        timings.add_since("vibe update", update_start_time)
+        # Devices are sent the newest intensity on their own clocks, so this runs even when the intensity hasn't changed
+        await self._update_intensity_for_devices(self.get_devices())